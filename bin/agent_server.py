@@ -1,52 +1,590 @@
 #!/usr/bin/env python3
 
 from concurrent import futures
+import asyncio
+import hashlib
+import importlib
+import inspect
+import json
 import logging
+import multiprocessing
+import resource
+import signal
+import sys
+import threading
 import time
 import argparse
+from collections import namedtuple
 from subprocess import check_call, CalledProcessError
-from os import path, geteuid
-from importlib import import_module
+from multiprocessing.connection import wait
+from os import path, chmod, getpid, geteuid, makedirs, replace, stat, unlink
+from threading import Lock, Event, Thread
 
 import grpc
 
 from dgrpc import agent_server_pb2 as pb
 from dgrpc import agent_server_pb2_grpc as pb_grpc
+from dgrpc.distributed_agent import relay_tree, method_key, GetMessageClass, Readiness
+from dgrpc.distributed_agent import DistributedAgentChannels, LatencyHistogram
+from google.protobuf import descriptor_pool
 
 log = logging.getLogger(__name__)
 
-def apt_install(deps):
+# apt/dpkg cannot run more than one install at a time.
+_apt_lock = Lock()
+
+# Set on calls one worker makes to another, see WorkerGroup.
+_WORKER_METADATA = 'dgrpc-worker'
+
+def _time_remaining(context):
+    '''The time remaining of the call, as a timeout. With no deadline grpc gives a time remaining
+    too large for wait() and friends, so that is None.'''
+    remaining = context.time_remaining()
+    return remaining if remaining is not None and remaining < 60 * 60 * 24 else None
+
+def _remove_socket(sock):
+    '''Remove a unix socket left behind by an earlier server, which would stop one binding to it.'''
+    try:
+        unlink(sock)
+    except FileNotFoundError:
+        pass
+
+class DependencyCache:
+    '''Knows which dependencies are already installed, so installing them again can be skipped.
+    Installed packages are read from the dpkg status file, which is only read again when it
+    changes. Source installs are recorded in a manifest file, by script and the sha256 of the
+    script, so a changed script is run again.'''
+    def __init__(self, manifest, status_file='/var/lib/dpkg/status'):
+        self._manifest = manifest
+        self._status_file = status_file
+        self._lock = Lock()
+        self._packages = set()
+        self._status_mtime = None
+        self._src = {}
+        try:
+            with open(manifest) as fd:
+                self._src = json.load(fd)
+        except (OSError, ValueError) as e:
+            log.debug('No src install manifest read from {}: {}'.format(manifest, e))
+
+    def _read_status(self):
+        try:
+            mtime = stat(self._status_file).st_mtime
+        except OSError:
+            return
+
+        if mtime == self._status_mtime:
+            return
+
+        packages = set()
+        package = None
+        with open(self._status_file, errors='replace') as fd:
+            for line in fd:
+                if line.startswith('Package: '):
+                    package = line[9:].strip()
+                elif line.startswith('Status: ') and line.split()[-1] == 'installed' and package:
+                    packages.add(package)
+
+        log.debug('Read {} installed packages from {}'.format(len(packages), self._status_file))
+        self._packages = packages
+        self._status_mtime = mtime
+
+    def missing(self, packages):
+        '''Return the packages that are not installed.'''
+        with self._lock:
+            self._read_status()
+            return [p for p in packages if not p in self._packages]
+
+    def add_packages(self, packages):
+        with self._lock:
+            self._packages.update(packages)
+
+    @staticmethod
+    def _script_hash(script):
+        with open(script, 'rb') as fd:
+            return hashlib.sha256(fd.read()).hexdigest()
+
+    def src_installed(self, script):
+        '''True if this version of the script has been installed from before.'''
+        try:
+            digest = self._script_hash(script)
+        except OSError:
+            return False
+
+        with self._lock:
+            return self._src.get(script) == digest
+
+    def add_src(self, script):
+        '''Record that script was installed, in the manifest.'''
+        try:
+            digest = self._script_hash(script)
+        except OSError as e:
+            log.warning('Unable to record src install of {}: {}'.format(script, e))
+            return
+
+        with self._lock:
+            self._src[script] = digest
+            try:
+                makedirs(path.dirname(self._manifest), exist_ok=True)
+                tmp = '{}.tmp'.format(self._manifest)
+                with open(tmp, 'w') as fd:
+                    json.dump(self._src, fd, indent=4)
+
+                replace(tmp, self._manifest)
+            except OSError as e:
+                log.warning('Unable to write src install manifest {}: {}'.format(self._manifest, e))
+
+class _AgentHandlers:
+    '''Stands in for the grpc server while an agent's AddServicer() adds its handlers, and keeps them.'''
+    def __init__(self):
+        self.services = {}
+        self.generic = []
+
+    def add_registered_method_handlers(self, service_name, method_handlers):
+        self.services[service_name] = method_handlers
+
+    def add_generic_rpc_handlers(self, generic_rpc_handlers):
+        self.generic.extend(generic_rpc_handlers)
+
+class AgentRouter(grpc.GenericRpcHandler):
+    '''Routes calls to the servicers of loaded agents. The router is added to the grpc server
+    before it starts, and agents are then registered with it rather than with the server, so
+    they can be added, replaced and removed while the server runs. Calls already running on a
+    replaced or removed servicer finish normally; new calls go to the new servicer or, if the
+    agent was removed, fail as unimplemented.'''
+    def __init__(self):
+        self._lock = Lock()
+        self._agents = {}
+        # The routing tables are rebuilt on every change and swapped in whole, so calls are
+        # routed without taking the lock.
+        self._services = {}
+        self._generic = []
+
+    def register(self, name, add_servicer, forward=None):
+        '''Register the agent name with the handlers add_servicer(server) adds, replacing the agent's
+        handlers if it was registered before. add_servicer is an agent module's AddServicer. If
+        forward, a channel, is given, calls are not handled here but passed on to the same methods
+        on forward.'''
+        handlers = _AgentHandlers()
+        add_servicer(handlers)
+        if forward is not None:
+            if handlers.generic and not handlers.services:
+                raise ValueError('{} only adds generic handlers, which cannot be forwarded'.format(name))
+
+            handlers.services = {
+                service: {method: _forwarding_handler(forward, '/{}/{}'.format(service, method), handler)
+                          for method, handler in methods.items()}
+                for service, methods in handlers.services.items()
+            }
+
+        with self._lock:
+            self._agents[name] = handlers
+            self._rebuild()
+
+    def unregister(self, name):
+        '''Remove the agent. Returns False if it was not registered.'''
+        with self._lock:
+            if self._agents.pop(name, None) is None:
+                return False
+
+            self._rebuild()
+            return True
+
+    def _rebuild(self):
+        services = {}
+        generic = []
+        for handlers in self._agents.values():
+            services.update(handlers.services)
+            # Older grpc only adds generic handlers.
+            if not handlers.services:
+                generic.extend(handlers.generic)
+
+        self._services = services
+        self._generic = generic
+
+    def service(self, handler_call_details):
+        service, _, method = handler_call_details.method.lstrip('/').partition('/')
+        handlers = self._services.get(service)
+        if handlers is not None:
+            return handlers.get(method)
+
+        for generic in self._generic:
+            handler = generic.service(handler_call_details)
+            if handler:
+                return handler
+
+        return None
+
+def _forwarding_handler(channel, method, handler):
+    '''Return a handler of the same kind as handler that calls method on channel with the request
+    and answers with what that returns. Messages are passed on as they are, without decoding.'''
+    if handler.request_streaming and handler.response_streaming:
+        call, make = channel.stream_stream(method), grpc.stream_stream_rpc_method_handler
+    elif handler.request_streaming:
+        call, make = channel.stream_unary(method), grpc.stream_unary_rpc_method_handler
+    elif handler.response_streaming:
+        call, make = channel.unary_stream(method), grpc.unary_stream_rpc_method_handler
+    else:
+        call, make = channel.unary_unary(method), grpc.unary_unary_rpc_method_handler
+
+    def forward(request, context):
+        try:
+            return call(request, timeout=_time_remaining(context))
+        except grpc.RpcError as e:
+            context.abort(e.code(), e.details())
+
+    def forward_stream(request, context):
+        responses = call(request, timeout=_time_remaining(context))
+        context.add_callback(responses.cancel)
+        try:
+            for response in responses:
+                yield response
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.CANCELLED:
+                context.abort(e.code(), e.details())
+
+    return make(forward_stream if handler.response_streaming else forward)
+
+class _LocalCallError(grpc.RpcError):
+    '''How a method called in-process by the daemon fails, so it is handled like a failed RPC.'''
+    def __init__(self, code, details):
+        super().__init__(details)
+        self._code = code
+        self._details = details
+
+    def code(self):
+        return self._code
+
+    def details(self):
+        return self._details
+
+_LocalCallDetails = namedtuple('_LocalCallDetails', ['method', 'invocation_metadata'])
+
+class _LocalContext:
+    '''Stands in for the grpc.ServicerContext of a unary method the daemon calls in-process. It
+    has what servicers use: aborting, setting the status and asking about the deadline.'''
+    def __init__(self, timeout):
+        self._deadline = None if timeout is None else time.monotonic() + timeout
+        self._callbacks = []
+        self.code = None
+        self.details = ''
+
+    def abort(self, code, details):
+        raise _LocalCallError(code, details)
+
+    def abort_with_status(self, status):
+        raise _LocalCallError(status.code, status.details)
+
+    def set_code(self, code):
+        self.code = code
+
+    def set_details(self, details):
+        self.details = details
+
+    def time_remaining(self):
+        return None if self._deadline is None else max(0, self._deadline - time.monotonic())
+
+    def expired(self):
+        return self._deadline is not None and time.monotonic() >= self._deadline
+
+    def is_active(self):
+        return not self.expired()
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+        return True
+
+    def done(self):
+        for callback in self._callbacks:
+            callback()
+
+    def invocation_metadata(self):
+        return ()
+
+    def peer(self):
+        return 'local'
+
+    def send_initial_metadata(self, metadata):
+        pass
+
+    def set_trailing_metadata(self, metadata):
+        pass
+
+class WorkerGroup:
+    '''The worker processes of a daemon started with --workers, as seen from one of them. All of 
+    them serve the daemon's port. Worker 0 is the owner: it installs dependencies, answers
+    Readiness and tells the other workers to load and unload agents as it does. Agents that keep
+    state, such as a running tcpdump, are only run by the owner; the other workers pass calls to
+    them on. Each worker also listens on a unix socket so the workers can call each other.'''
+    def __init__(self, index, count, socket_dir, port):
+        self.index = index
+        self.count = count
+        self._sockets = [path.join(socket_dir, 'worker-{}-{}.sock'.format(port, i)) for i in range(count)]
+        self._channels = {}
+        self._lock = Lock()
+
+    @property
+    def owner(self):
+        return self.index == 0
+
+    def others(self):
+        return [i for i in range(self.count) if i != self.index]
+
+    def address(self, index=None):
+        return 'unix:{}'.format(self._sockets[self.index if index is None else index])
+
+    @property
+    def socket(self):
+        return self._sockets[self.index]
+
+    def channel(self, index):
+        with self._lock:
+            if not index in self._channels:
+                # Passed on messages can be as large as the server allows.
+                self._channels[index] = grpc.insecure_channel(self.address(index), options=_server_options)
+
+            return self._channels[index]
+
+    def stub(self, index):
+        return pb_grpc.AgentServerStub(self.channel(index))
+
+class ServerStats:
+    '''How busy the daemon is and how long the calls it serves take, for the Stats RPC. Kept by
+    StatsInterceptor: recording a call is a few clock reads, a lock and two histogram updates,
+    so it can be left on.'''
+    def __init__(self, executor, poolsize):
+        self._executor = executor
+        self._poolsize = poolsize
+        self._lock = Lock()
+        self._started = time.monotonic()
+        # Calls running, by method, and of those, the ones on a pool thread.
+        self._running = {}
+        self._busy = 0
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._since = time.monotonic()
+            self._max_busy = self._busy
+            self._queue_wait = LatencyHistogram()
+            self._latency = {}
+
+    def start(self, method, arrived, threaded):
+        '''A call to method that arrived at the monotonic time arrived has started running.'''
+        now = time.monotonic()
+        with self._lock:
+            self._running[method] = self._running.get(method, 0) + 1
+            if threaded:
+                self._busy += 1
+                self._max_busy = max(self._max_busy, self._busy)
+                self._queue_wait.record(now - arrived)
+
+    def finish(self, method, arrived, threaded, error):
+        now = time.monotonic()
+        with self._lock:
+            self._running[method] -= 1
+            if threaded:
+                self._busy -= 1
+
+            h = self._latency.get(method)
+            if h is None:
+                h = self._latency[method] = LatencyHistogram()
+
+            h.record(now - arrived, error)
+
+    def report(self, reset=False, worker=0):
+        '''Return a StatsResponse, and start counting afresh if reset.'''
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        with open('/proc/self/statm') as fd:
+            rss = int(fd.read().split()[1]) * resource.getpagesize()
+
+        with self._lock:
+            response = pb.StatsResponse(
+                in_flight=sum(self._running.values()), poolsize=self._poolsize, max_busy=self._max_busy,
+                queue_wait=self._queue_wait.to_pb(), cpu_user=usage.ru_utime, cpu_system=usage.ru_stime,
+                rss_bytes=rss, threads=threading.active_count(), uptime=time.monotonic() - self._started,
+                pid=getpid(), worker=worker, interval=time.monotonic() - self._since)
+            for method in sorted(set(self._running) | set(self._latency)):
+                h = self._latency.get(method, LatencyHistogram())
+                response.methods.add(method=method, in_flight=self._running.get(method, 0), latency=h.to_pb())
+
+        # Calls waiting for a thread are in the executor's work queue, which is not public.
+        work_queue = getattr(self._executor, '_work_queue', None)
+        response.queued = work_queue.qsize() if work_queue is not None else 0
+        response.in_flight += response.queued
+
+        if reset:
+            self.reset()
+
+        return response
+
+# Service.Method of each method path called.
+_method_keys = {}
+
+def _stats_handler(stats, handler, method):
+    '''Return handler with its behavior wrapped to record the call in stats. Coroutines and async
+    generators are wrapped as such, so an asyncio server still runs them on its loop.'''
+    arrived = time.monotonic()
+    key = _method_keys.get(method)
+    if key is None:
+        key = _method_keys[method] = method_key(method)
+
+    if handler.request_streaming:
+        kind = 'stream_stream' if handler.response_streaming else 'stream_unary'
+    else:
+        kind = 'unary_stream' if handler.response_streaming else 'unary_unary'
+
+    behavior = getattr(handler, kind)
+    if inspect.isasyncgenfunction(behavior):
+        async def wrapped(request, context):
+            stats.start(key, arrived, False)
+            error = True
+            try:
+                async for response in behavior(request, context):
+                    yield response
+                error = False
+            finally:
+                stats.finish(key, arrived, False, error)
+    elif inspect.iscoroutinefunction(behavior):
+        async def wrapped(request, context):
+            stats.start(key, arrived, False)
+            error = True
+            try:
+                response = await behavior(request, context)
+                error = False
+                return response
+            finally:
+                stats.finish(key, arrived, False, error)
+    elif handler.response_streaming:
+        def wrapped(request, context):
+            stats.start(key, arrived, True)
+            error = True
+            try:
+                yield from behavior(request, context)
+                error = False
+            finally:
+                stats.finish(key, arrived, True, error)
+    else:
+        def wrapped(request, context):
+            stats.start(key, arrived, True)
+            error = True
+            try:
+                response = behavior(request, context)
+                error = False
+                return response
+            finally:
+                stats.finish(key, arrived, True, error)
+
+    return handler._replace(**{kind: wrapped})
+
+class StatsInterceptor(grpc.ServerInterceptor):
+    '''Records every call the server serves in a ServerStats.'''
+    def __init__(self, stats):
+        self._stats = stats
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+
+        return _stats_handler(self._stats, handler, handler_call_details.method)
+
+class AsyncStatsInterceptor(grpc.aio.ServerInterceptor):
+    '''StatsInterceptor for grpc.aio servers.'''
+    def __init__(self, stats):
+        self._stats = stats
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+
+        return _stats_handler(self._stats, handler, handler_call_details.method)
+
+def apt_install(deps, cache=None):
+    if cache:
+        missing = cache.missing(deps)
+        if not missing:
+            log.info('apt dependency "{}" already installed'.format(' '.join(deps)))
+            return True
+
+        deps = missing
+
     cmd = 'apt-get install -y {}'.format(' '.join(deps))
     try:
         log.info('attempting apt install via "{}"'.format(cmd))
-        check_call(cmd.split(), close_fds=True)
+        with _apt_lock:
+            check_call(cmd.split(), close_fds=True)
     except CalledProcessError as e:
         return False
 
+    if cache:
+        cache.add_packages(deps)
+
     log.info('successfully installed apt dependency "{}"'.format(' '.join(deps)))
     return True
 
-def src_install(src_dir, script):
+def src_install(src_dir, script, cache=None):
     cmd = [path.join(src_dir, script), src_dir, '/tmp']
+    if cache and cache.src_installed(cmd[0]):
+        log.info('src dependency "{}" already installed'.format(script))
+        return True
+
     try:
         log.info('attemping src install via "{}"'.format(' '.join(cmd)))
         check_call(cmd, close_fds=True)
     except CalledProcessError as e:
         return False
 
+    if cache:
+        cache.add_src(cmd[0])
+
     log.info('successfully installed src dependency "{}"'.format(script))
     return True
 
 class AgentServerServicer(pb_grpc.AgentServerServicer):
     '''A simple class that loads agents and their dependencies.'''
-    def __init__(self, server, config):
+    def __init__(self, server, config, port, workers=None, local_target=None, stats=None):
         log.debug('AgentServerServicer created.')
         self._server = server
+        self._port = port
+        # The ServerStats the server's StatsInterceptor keeps, if it has one.
+        self._stats = stats
+        # Where this daemon calls itself, i.e. to run the local part of a Relay.
+        self._local_target = local_target if local_target else 'localhost:{}'.format(port)
+        # The WorkerGroup this is part of, if there is more than one worker.
+        self._workers = workers
+        # Agents are added to the router, which is added to the server here, before it starts.
+        self._router = AgentRouter()
+        server.add_generic_rpc_handlers((self._router,))
 
         self._deps_loaded = []
+        # Agents whose servicers have been added to the server, by name, with the module they 
+        # came from. Loading one of these again is a no-op.
+        self._loaded = {}
+        self._load_locks = {}
+        # Readiness state and comment of each agent's dependencies, and an event set once its
+        # install has finished, one way or the other.
+        self._readiness = {}
+        self._installed = {}
+        self._install_locks = {}
 
         with open(config) as fd:
-            self._config = yaml.load(fd)
+            self._config = yaml.safe_load(fd)
+
+        self._deps_cache = DependencyCache(self._config.get('dependency_manifest', '/var/lib/dgrpc/src_installs.json'))
+
+        for agent in self._config['agents']:
+            self._readiness[agent] = (Readiness.NOT_INSTALLED, '')
+            self._installed[agent] = Event()
+            self._install_locks[agent] = Lock()
+            self._load_locks[agent] = Lock()
+
+        # Relayed calls to this node and to the daemons below it in the relay tree.
+        self._relay_pool = futures.ThreadPoolExecutor(
+            max_workers=self._config.get('relay_poolsize', 32), thread_name_prefix='relay')
+        self._relay_channels = {}
+        self._relay_lock = Lock()
 
         self._handle_init_config()
 
@@ -62,22 +600,113 @@ class AgentServerServicer(pb_grpc.AgentServerServicer):
         else:
             logfile = self._config['logging']['logfile']
 
+        # All workers log to the same file, so only the owner starts it afresh.
+        fmt = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
+        if self._workers:
+            fmt = '%(asctime)s %(processName)-8s %(name)-12s %(levelname)-8s %(message)s'
+
         logging.basicConfig(level=level, 
                             filename=logfile,
-                            format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                            format=fmt,
                             datefmt='%m-%d %H:%M',
-                            filemode='w')
+                            filemode='w' if not self._workers or self._workers.owner else 'a')
         log.info('log level set to {}. loging to {}'.format(level, logfile))
 
-        for agent, aconf in self._config['agents'].items():
-            if aconf['dependencies']['when'] == 'preload':
-                success, comment = self._load_dependencies(agent, aconf['dependencies']['how'])
-                if not success:
-                    log.critical('Unable to preload {} dependencies: {}'.format(agent, comment))
-                    exit(99)   # what else to do?
+        if self._workers and not self._workers.owner:
+            # The owner installs dependencies. Load what it already has, in case this worker
+            # was restarted.
+            Thread(target=self._sync_loaded, name='sync', daemon=True).start()
+            return
+
+        # Install preload dependencies in the background so the server can start answering
+        # right away. Load() of an agent waits for its install to finish.
+        preload = [a for a, aconf in self._config['agents'].items() if aconf['dependencies']['when'] == 'preload']
+        for agent in preload:
+            self._readiness[agent] = (Readiness.INSTALLING, '')
+
+        self._preload_thread = Thread(target=self._preload, args=(preload,), name='preload', daemon=True)
+        self._preload_thread.start()
+
+    def _preload(self, agents):
+        '''Install the dependencies of the given agents. Agents that are installed with apt first
+        are installed together in a single apt transaction. If that fails, or the agent is not
+        installed with apt, each agent's installers are tried as usual, all at the same time.'''
+        if not agents:
+            return
+
+        start = time.monotonic()
+        try:
+            how = {a: self._config['agents'][a]['dependencies']['how'] for a in agents}
+            apt_agents = [a for a in agents if how[a][0].get('apt')] if len(agents) > 1 else []
+            with futures.ThreadPoolExecutor(max_workers=len(agents), thread_name_prefix='preload') as tpe:
+                # Source builds do not wait on apt.
+                for a in agents:
+                    if not a in apt_agents:
+                        tpe.submit(self._load_dependencies, a, how[a])
+
+                if apt_agents:
+                    packages = []
+                    for a in apt_agents:
+                        packages.extend(p for p in how[a][0]['apt'] if not p in packages)
+
+                    try:
+                        installed = apt_install(packages, self._deps_cache)
+                    except Exception as e:
+                        log.exception('Error in combined apt install: {}'.format(e))
+                        installed = False
+
+                    if installed:
+                        for a in apt_agents:
+                            self._set_installed(a, True, 'Installed {} dependencies via apt.'.format(a))
+                    else:
+                        log.warning('Combined apt install failed, installing agent dependencies one by one.')
+                        for a in apt_agents:
+                            tpe.submit(self._load_dependencies, a, how[a])
+        finally:
+            # Whatever went wrong, Load() of these agents must not wait forever.
+            for a in agents:
+                if not self._installed[a].is_set():
+                    self._set_installed(a, False, 'Preload of {} dependencies did not finish.'.format(a))
+
+        for a in agents:
+            if self._readiness[a][0] == Readiness.FAILED:
+                log.critical('Unable to preload {} dependencies: {}'.format(a, self._readiness[a][1]))
+
+        log.info('Preloaded dependencies of {} in {:.1f}s'.format(', '.join(agents), time.monotonic() - start))
+
+    def _set_installed(self, agent, success, comment):
+        if success and not agent in self._deps_loaded:
+            self._deps_loaded.append(agent)
+
+        self._readiness[agent] = (Readiness.READY if success else Readiness.FAILED, comment)
+        self._installed[agent].set()
+
+    def Readiness(self, request, context):
+        if self._workers and not self._workers.owner:
+            return self._forward('Readiness', request, context)
+
+        names = request.names if request.names else self._config['agents'].keys()
+        response = pb.ReadinessResponse()
+        for name in names:
+            state, comment = self._readiness.get(name, (Readiness.FAILED, 'Unknown agent {}.'.format(name)))
+            response.agents.add(name=name, state=state, comment=comment, loaded=name in self._loaded)
+
+        return response
+
+    def Stats(self, request, context):
+        if not self._stats:
+            context.abort(grpc.StatusCode.UNIMPLEMENTED, 'This server does not keep stats.')
+
+        return self._stats.report(request.reset, self._workers.index if self._workers else 0)
 
     def Load(self, request, context):
         name = request.name
+        if name in self._loaded and not request.reload:
+            log.debug('{} already loaded'.format(name))
+            return pb.Response(success=True, comment='{} already loaded.'.format(name))
+
+        if self._workers and not self._workers.owner and not self._from_owner(context):
+            return self._forward('Load', request, context)
 
         log.info('Loading agent {}'.format(name))
 
@@ -85,52 +714,336 @@ class AgentServerServicer(pb_grpc.AgentServerServicer):
             cmt = 'Unknown agent {}. Must be one of {}.'.format(
                 name, ', '.join(self._config['agents'].keys()))
             return pb.Response(success=False, comment=cmt)
-        
+
+        # Agents loading at the same time as this one wait for it and then find it loaded.
+        with self._load_locks[name]:
+            if name in self._loaded and not request.reload:
+                return pb.Response(success=True, comment='{} already loaded.'.format(name))
+
+            response = self._load(name, context)
+
+        if response.success and self._workers and self._workers.owner:
+            self._broadcast('Load', request)
+
+        return response
+
+    def Unload(self, request, context):
+        name = request.name
+        if self._workers and not self._workers.owner and not self._from_owner(context):
+            return self._forward('Unload', request, context)
+
+        with self._load_locks.get(name, Lock()):
+            if not self._router.unregister(name):
+                return pb.Response(success=False, comment='{} is not loaded.'.format(name))
+
+            self._loaded.pop(name, None)
+
+        if self._workers and self._workers.owner:
+            self._broadcast('Unload', request)
+
+        log.info('{} unloaded'.format(name))
+        return pb.Response(success=True, comment='{} unloaded.'.format(name))
+
+    def _from_owner(self, context):
+        return _WORKER_METADATA in dict(context.invocation_metadata())
+
+    def _forward(self, method, request, context):
+        '''Pass an AgentServer call from a client on to the owner worker and return its answer.'''
+        try:
+            return getattr(self._workers.stub(0), method)(request, timeout=_time_remaining(context))
+        except grpc.RpcError as e:
+            log.error('Unable to pass {} on to the owner worker: {}'.format(method, e.details()))
+            context.abort(e.code(), e.details())
+
+    def _broadcast(self, method, request):
+        '''Have the other workers do the Load or Unload this one, the owner, just did.'''
+        metadata = ((_WORKER_METADATA, str(self._workers.index)),)
+        calls = {self._relay_pool.submit(getattr(self._workers.stub(i), method), request, metadata=metadata): i
+                 for i in self._workers.others()}
+        for f in futures.as_completed(calls):
+            try:
+                response = f.result()
+            except grpc.RpcError as e:
+                # A worker that is not up yet syncs with the owner when it starts.
+                log.warning('Unable to {} {} on worker {}: {}'.format(method, request.name, calls[f], e.details()))
+                continue
+
+            if not response.success:
+                log.error('Worker {} failed to {} {}: {}'.format(calls[f], method, request.name, response.comment))
+
+    def _sync_loaded(self):
+        '''Load the agents the owner worker has loaded.'''
+        try:
+            readiness = self._workers.stub(0).Readiness(pb.ReadinessArgs(), wait_for_ready=True)
+        except grpc.RpcError as e:
+            log.error('Unable to ask the owner worker which agents are loaded: {}'.format(e.details()))
+            return
+
+        for agent in readiness.agents:
+            if agent.loaded:
+                with self._load_locks[agent.name]:
+                    if not agent.name in self._loaded:
+                        self._load(agent.name, None)
+
+    def _load(self, name, context):
         conf = self._config['agents'][name]
-        if conf['dependencies']['when'] != 'preload':
+        if self._workers and not self._workers.owner:
+            # Only asked to load by the owner, once it has installed the dependencies.
+            success, comment = True, ''
+        elif conf['dependencies']['when'] != 'preload':
             success, comment = self._load_dependencies(name, conf['dependencies']['how'])
-            if not success:
-                log.critical('Unable to preload {} dependencies: {}'.format(agent, comment))
-                return pb.Response(success, comment)
-
-        # import the servicer module and let it add itself to our server. 
-        modname = self._config['agents'][name]['module']
-        mod = import_module('dgrpc.{}'.format(modname))
-        mod.AddServicer(self._server)
-        
-        log.info('{} loaded via {}'.format(name, modname))
-        return pb.Response(success=True, comment='{} loaded.'.format(name))
+        else:
+            if not self._installed[name].wait(_time_remaining(context)):
+                return pb.Response(success=False, comment='{} dependencies are still being installed.'.format(name))
+
+            state, comment = self._readiness[name]
+            success = state == Readiness.READY
+
+        if not success:
+            log.critical('Unable to load {} dependencies: {}'.format(name, comment))
+            return pb.Response(success=success, comment=comment)
+
+        # import the servicer module and let it add itself to the router. A reload imports the
+        # module again, so a new version of it replaces the running servicer.
+        modname = 'dgrpc.{}'.format(self._config['agents'][name]['module'])
+        try:
+            if name in self._loaded and modname in sys.modules:
+                mod = importlib.reload(sys.modules[modname])
+            else:
+                mod = importlib.import_module(modname)
+
+            # Only the owner worker runs agents that keep state; the others pass their calls on.
+            forward = None
+            if self._workers and not self._workers.owner and conf.get('workers', 'owner') != 'all':
+                forward = self._workers.channel(0)
+
+            self._router.register(name, mod.AddServicer, forward)
+        except Exception as e:
+            log.critical('Unable to load {} from {}: {}'.format(name, modname, e))
+            return pb.Response(success=False, comment='Unable to load {}: {}'.format(name, e))
+
+        reloaded = name in self._loaded
+        self._loaded[name] = modname
+        log.info('{} {} via {}'.format(name, 'reloaded' if reloaded else 'loaded', modname))
+        return pb.Response(success=True, comment='{} {}.'.format(name, 'reloaded' if reloaded else 'loaded'))
+
+    def Relay(self, request, context):
+        '''Call the method on this node and relay it to the subtree, all at once. Nodes that cannot
+        be reached are reported as not ok rather than failing the whole relay.'''
+        # Leave some of the caller's deadline for collecting and returning the responses.
+        timeout = request.timeout * 0.9 if request.timeout else None
+        calls = {}
+        local_request = request.node_requests.get(request.node, request.request)
+        calls[self._relay_pool.submit(self._timed_call_local, request.method, local_request, timeout)] = (request.node, [])
+        for child, subtree in relay_tree(request.subtree, request.fanout):
+            log.debug('relaying {} to {} and {} nodes below it'.format(request.method, child, len(subtree)))
+            calls[self._relay_pool.submit(self._relay_to, child, subtree, request, timeout)] = (child, subtree)
+
+        relayed = pb.RelayResponse()
+        for f in futures.as_completed(calls):
+            node, subtree = calls[f]
+            try:
+                result = f.result()
+            except grpc.RpcError as e:
+                # The whole subtree is lost along with the node.
+                comment = 'RPC error via {}: {}'.format(node, e.details())
+                timed_out = e.code() == grpc.StatusCode.DEADLINE_EXCEEDED
+                log.error(comment)
+                for n in [node] + subtree:
+                    relayed.responses.add(node=n, ok=False, comment=comment, timed_out=timed_out)
+
+                continue
+
+            if isinstance(result, pb.RelayResponse):
+                relayed.responses.extend(result.responses)
+            else:
+                response, latency = result
+                relayed.responses.add(node=node, ok=True, response=response, latency=latency)
+
+        return relayed
+
+    def RunPlan(self, request, context):
+        '''Run the steps of the plan in order, yielding each result as it completes. Stops at the 
+        first failed step unless told otherwise, or if the caller goes away.'''
+        cancelled = Event()
+        context.add_callback(cancelled.set)
+        for i, step in enumerate(request.steps):
+            if step.delay and cancelled.wait(step.delay):
+                log.info('plan cancelled before step {}'.format(i))
+                return
+
+            if cancelled.is_set():
+                return
+
+            log.debug('running plan step {}: {}'.format(i, step.method))
+            try:
+                response = self._call_local(step.method, step.request, step.timeout if step.timeout else None)
+            except grpc.RpcError as e:
+                log.error('plan step {} ({}) failed: {}'.format(i, step.method, e.details()))
+                yield pb.StepResult(step=i, ok=False, comment=e.details(),
+                                    timed_out=e.code() == grpc.StatusCode.DEADLINE_EXCEEDED)
+                if not request.continue_on_failure:
+                    return
+
+                continue
+
+            yield pb.StepResult(step=i, ok=True, response=response)
+            if not request.continue_on_failure and not self._step_succeeded(step.method, response):
+                log.info('plan step {} ({}) was not successful, stopping.'.format(i, step.method))
+                return
+
+    def _step_succeeded(self, method, response):
+        '''Return the success field of a serialized response, if the response has one.'''
+        try:
+            service, name = method.lstrip('/').split('/')
+            md = descriptor_pool.Default().FindServiceByName(service).methods_by_name[name]
+            r = GetMessageClass(md.output_type).FromString(response)
+        except (KeyError, ValueError) as e:
+            log.debug('Unable to decode response of {}: {}'.format(method, e))
+            return True
+
+        return getattr(r, 'success', True)
+
+    def _relay_channel(self, target):
+        with self._relay_lock:
+            if not target in self._relay_channels:
+                self._relay_channels[target] = grpc.insecure_channel(target)
+
+            return self._relay_channels[target]
+
+    def _call_local(self, method, request, timeout):
+        '''Call the (serialized) request on the given method of this daemon and return the serialized response.
+        Unary methods of loaded agents are called in-process, on the calling thread. Calling them over
+        grpc would need a second server thread while this one waits, which with enough concurrent
+        relays and plans leaves none to answer. Anything else, i.e. async servicers, which run on
+        the server's event loop, is called over grpc.'''
+        handler = self._router.service(_LocalCallDetails(method, ()))
+        if (handler is None or handler.request_streaming or handler.response_streaming
+                or inspect.iscoroutinefunction(handler.unary_unary)):
+            channel = self._relay_channel(self._local_target)
+            return channel.unary_unary(method)(request, timeout=timeout)
+
+        key = _method_keys.get(method)
+        if key is None:
+            key = _method_keys[method] = method_key(method)
+
+        context = _LocalContext(timeout)
+        arrived = time.monotonic()
+        if self._stats:
+            self._stats.start(key, arrived, False)
+
+        error = True
+        try:
+            if handler.request_deserializer:
+                request = handler.request_deserializer(request)
+
+            response = handler.unary_unary(request, context)
+            if context.code not in [None, grpc.StatusCode.OK]:
+                raise _LocalCallError(context.code, context.details)
+            if context.expired():
+                # As the caller would have seen it over grpc.
+                raise _LocalCallError(grpc.StatusCode.DEADLINE_EXCEEDED, 'Deadline Exceeded')
+
+            error = False
+            return handler.response_serializer(response) if handler.response_serializer else response
+        except grpc.RpcError:
+            raise
+        except Exception as e:
+            log.exception('{} failed'.format(method))
+            raise _LocalCallError(grpc.StatusCode.UNKNOWN, 'Exception calling application: {}'.format(e))
+        finally:
+            context.done()
+            if self._stats:
+                self._stats.finish(key, arrived, False, error)
+
+    def _timed_call_local(self, method, request, timeout):
+        '''_call_local(), but returns (response, seconds taken).'''
+        start = time.monotonic()
+        response = self._call_local(method, request, timeout)
+        return response, time.monotonic() - start
+
+    def _relay_to(self, node, subtree, request, timeout):
+        channel = self._relay_channel('{}:{}'.format(node, request.port))
+        node_requests = {n: request.node_requests[n] for n in [node] + subtree if n in request.node_requests}
+        relay_args = pb.RelayArgs(method=request.method, request=request.request, node=node, subtree=subtree,
+                                  fanout=request.fanout, port=request.port, timeout=timeout,
+                                  node_requests=node_requests)
+        return pb_grpc.AgentServerStub(channel).Relay(relay_args, timeout=timeout)
 
     def _load_dependencies(self, agent, installers):
-        if agent in self._deps_loaded:
-            return True, '{} dependencies already installed.'
+        # Only one install of an agent at a time; a second Load waits for the first to finish.
+        with self._install_locks[agent]:
+            if agent in self._deps_loaded:
+                return True, '{} dependencies already installed.'.format(agent)
+
+            self._readiness[agent] = (Readiness.INSTALLING, '')
+            try:
+                success, comment = self._install(agent, installers)
+            except Exception as e:
+                # i.e. a missing src script. Load() waits on the result, so there must be one.
+                log.exception('Error installing {} dependencies'.format(agent))
+                success, comment = False, 'Error installing {} dependencies: {}'.format(agent, e)
+
+            self._set_installed(agent, success, comment)
+            return success, comment
 
-        success = False
+    def _install(self, agent, installers):
         for installer in installers:
             if 'apt' in installer and installer['apt']:
-                if apt_install(installer['apt']):
-                    success = True
-                    break
+                if apt_install(installer['apt'], self._deps_cache):
+                    return True, 'Installed {} dependencies via a {} install.'.format(agent, installer)
             elif 'src' in installer and installer['src']:
-                if src_install(self._config['dependency_sources'], installer['src']):
-                    success = True
-                    break
+                if src_install(self._config['dependency_sources'], installer['src'], self._deps_cache):
+                    return True, 'Installed {} dependencies via a {} install.'.format(agent, installer)
             else:
                 return False, 'Misconfiguration: I do not know how to install dependencies like {}'.format(installer)
-            
-        if success:
-            self._deps_loaded.append(agent)
-            return True, 'Installed {} dependencies via a {} install.'.format(agent, installer)
 
         return False, 'Unable to install {} dependency using {}'.format(agent, installers)
 
 
-def serve(port, poolsize, config):
+# Allow the keepalive pings clients send (see DistributedAgentChannels) so the connections 
+# are not dropped for pinging too often.
+_server_options = [
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.min_ping_interval_without_data_ms', 10000),
+    ('grpc.http2.max_pings_without_data', 0),
+    ('grpc.max_send_message_length', 64 * 1024 * 1024),
+    ('grpc.max_receive_message_length', 64 * 1024 * 1024),
+]
+
+def _add_ports(server, port, workers, unix_socket):
+    '''Add the ports the server listens on and return the address it should call itself on.'''
+    server.add_insecure_port('[::]:{}'.format(port))
+    local_target = 'localhost:{}'.format(port)
+    # Unlike the port, a unix socket cannot be shared, so only the owner worker listens on it.
+    if unix_socket and (not workers or workers.owner):
+        makedirs(path.dirname(unix_socket), exist_ok=True)
+        _remove_socket(unix_socket)
+        server.add_insecure_port('unix:{}'.format(unix_socket))
+        # Anyone on the host can connect over TCP, so the same goes for the socket.
+        chmod(unix_socket, 0o666)
+        local_target = 'unix:{}'.format(unix_socket)
+
+    if workers:
+        _remove_socket(workers.socket)
+        server.add_insecure_port(workers.address())
+        # Keep local calls in this worker.
+        local_target = workers.address()
+
+    return local_target
+
+def _options(workers):
+    # Workers share the port. grpc sets SO_REUSEPORT by default, but say so.
+    return _server_options + [('grpc.so_reuseport', 1)] if workers else _server_options
+
+def serve(port, poolsize, config, workers=None, unix_socket=None):
     # We start with only one servicer loaded, namely a servicer which knows how
     # to load other servicers (agents). 
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=poolsize))
-    server.add_insecure_port('[::]:{}'.format(port))
-    agent_server = AgentServerServicer(server, config)
+    executor = futures.ThreadPoolExecutor(max_workers=poolsize)
+    stats = ServerStats(executor, poolsize)
+    server = grpc.server(executor, interceptors=[StatsInterceptor(stats)], options=_options(workers))
+    local_target = _add_ports(server, port, workers, unix_socket)
+    agent_server = AgentServerServicer(server, config, port, workers, local_target, stats)
     pb_grpc.add_AgentServerServicer_to_server(agent_server, server)
     server.start()
 
@@ -142,6 +1055,76 @@ def serve(port, poolsize, config):
     except KeyboardInterrupt:
         server.stop(0)
 
+async def serve_async(port, poolsize, config, workers=None, unix_socket=None):
+    '''Serve from an asyncio event loop. Agent methods that are coroutines (see the async servicer 
+    templates) run on the loop, so any number of streams and calls can be open at once. Plain 
+    methods, including the AgentServer's own, run in a pool of poolsize threads as usual.'''
+    executor = futures.ThreadPoolExecutor(max_workers=poolsize)
+    stats = ServerStats(executor, poolsize)
+    server = grpc.aio.server(migration_thread_pool=executor, interceptors=[AsyncStatsInterceptor(stats)],
+                             options=_options(workers))
+    local_target = _add_ports(server, port, workers, unix_socket)
+    agent_server = AgentServerServicer(server, config, port, workers, local_target, stats)
+    pb_grpc.add_AgentServerServicer_to_server(agent_server, server)
+    await server.start()
+    try:
+        await server.wait_for_termination()
+    finally:
+        await server.stop(0)
+
+def _run_worker(workers, port, poolsize, config, use_asyncio, unix_socket):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if use_asyncio:
+        try:
+            asyncio.run(serve_async(port, poolsize, config, workers, unix_socket))
+        except KeyboardInterrupt:
+            pass
+    else:
+        serve(port, poolsize, config, workers, unix_socket)
+
+def serve_workers(port, poolsize, config, count, use_asyncio=False, unix_socket=None):
+    '''Run count worker processes that all serve port, so calls are spread over as many cores. 
+    See WorkerGroup. A worker that exits is started again, unless it is the owner: the agents it
+    ran are gone with it, so then all workers are stopped.'''
+    with open(config) as fd:
+        socket_dir = yaml.safe_load(fd).get('worker_sockets', '/run/dgrpc')
+
+    makedirs(socket_dir, exist_ok=True)
+    # Stop the workers too when stopped.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Workers are forked before this process makes any grpc calls, which grpc requires.
+    procs = {}
+    def start(i):
+        workers = WorkerGroup(i, count, socket_dir, port)
+        procs[i] = multiprocessing.Process(target=_run_worker, name='worker-{}'.format(i),
+                                           args=(workers, port, poolsize, config, use_asyncio, unix_socket))
+        procs[i].start()
+
+    for i in range(count):
+        start(i)
+
+    try:
+        while True:
+            wait([p.sentinel for p in procs.values()])
+            for i, p in list(procs.items()):
+                if p.is_alive():
+                    continue
+
+                if i == 0:
+                    log.critical('Owner worker exited with {}, stopping.'.format(p.exitcode))
+                    return 1
+
+                log.error('Worker {} exited with {}, restarting it.'.format(i, p.exitcode))
+                start(i)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        for p in procs.values():
+            p.terminate()
+
+        for p in procs.values():
+            p.join()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Start all configured agents on this machine.')
     parser.add_argument('-p', '--port', type=int, help='Port the agent server is listening on.', default=51000)
@@ -149,6 +1132,13 @@ if __name__ == '__main__':
                         help='Number of threads to spawn to serve agent requests.')
     parser.add_argument('-c', '--config', type=str, default='/etc/dgrpc/dgrpc.conf',
                         help='Path to configration file. Default=/etc/dgprc/dgrpc.conf')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='Serve from an asyncio event loop, so async agent methods do not use a thread.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes to serve the port with. Default=1')
+    parser.add_argument('--unix-socket', type=str, nargs='?', default=None, const='',
+                        help='Also listen on this unix socket, for clients on this host. Default={}'.format(
+                            DistributedAgentChannels.unix_socket))
     args = parser.parse_args()
 
     if geteuid() != 0:
@@ -165,4 +1155,17 @@ if __name__ == '__main__':
 
         import yaml
 
-    serve(args.port, args.poolsize, args.config)
+    # Where DistributedAgent looks for it, if no path is given.
+    unix_socket = args.unix_socket
+    if unix_socket == '':
+        unix_socket = DistributedAgentChannels.unix_socket.format(port=args.port)
+
+    if args.workers > 1:
+        exit(serve_workers(args.port, args.poolsize, args.config, args.workers, args.asyncio, unix_socket))
+    elif args.asyncio:
+        try:
+            asyncio.run(serve_async(args.port, args.poolsize, args.config, unix_socket=unix_socket))
+        except KeyboardInterrupt:
+            pass
+    else:
+        serve(args.port, args.poolsize, args.config, unix_socket=unix_socket)
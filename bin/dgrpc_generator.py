@@ -4,10 +4,14 @@ import logging
 import sys
 import re   # now I've got two problems.
 
-from google.protobuf.descriptor_pb2 import DescriptorProto, ServiceDescriptorProto, FieldDescriptorProto
+from google.protobuf.descriptor_pb2 import DescriptorProto, ServiceDescriptorProto, FieldDescriptorProto, MethodOptions
 
 log = logging.getLogger(__name__)
 
+# The keyword arguments of DistributedAgent.blocking_call() and friends, which the generated methods
+# take along with the fields of their message. See call_options() in distributed_agent.py.
+_call_options = ['timeout', 'completion', 'count', 'per_node', 'retry', 'hedge', 'yield_errors']
+
 client_header = '''
 #
 # This file generated from a proto file. You can edit it, but it may 
@@ -25,7 +29,7 @@ import grpc
 from . import {}_pb2 as pb
 from . import {}_pb2_grpc as pb_grpc
 
-from .distributed_agent import DistributedAgent, DistributedAgentException
+from .distributed_agent import DistributedAgent, AsyncDistributedAgent, DistributedAgentException, call_options
 from .distributed_agent import DistributedAgentResponses as Responses
 
 log = logging.getLogger(__name__)
@@ -71,12 +75,12 @@ def field2arg_default(f):
         FieldDescriptorProto.TYPE_UINT32: 'None',
         FieldDescriptorProto.TYPE_UINT64: 'None',
         FieldDescriptorProto.TYPE_MESSAGE: 'None',
+        FieldDescriptorProto.TYPE_BYTES: "b''",
         # Unsupported types - raise exception.
         # FieldDescriptorProto.TYPE_ENUM: 'None',
         # FieldDescriptorProto.TYPE_FIELD_NUMBER: 'None',
         # FieldDescriptorProto.TYPE_NAME_FIELD_NUMBER: 'None',
         # FieldDescriptorProto.TYPE_GROUP: 'None',
-        # FieldDescriptorProto.TYPE_BYTES: 'None',
     }
 
     t = f.type
@@ -91,7 +95,7 @@ def field2arg_default(f):
 #           pb.OutsideArgs(
 #               one=1,
 #               two=2,
-#               pb.InsideArgs(
+#               inside=pb.OutsideArgs.InsideArgs(
 #                   three=3,
 #                   four=4
 #               )
@@ -99,31 +103,34 @@ def field2arg_default(f):
 # )
 # This is not needed for python dicts, which is why I wrote it. For dicts, we can just 
 # use the map<> protobuf type.
-def message2invocation(message, defaults=False):
+def message2invocation(message, defaults=False, scope=''):
     '''take a message and convert it into something that looks like a function call:
-        Foobar(one=one, two=two, three=BarBar(four=four, five=five))
+        Foobar(one=one, two=two, three=pb.Foobar.BarBar(four=four, five=five))
     If defaults is True, use the default of the types rather than the actual variables:
-        Foobar(one=None, two='', three=BarBar(four=None, five=None))
+        Foobar(one=None, two='', three=pb.Foobar.BarBar(four=None, five=None), six=[])
+    Repeated and map fields default to empty ones. scope is the name of the message the given
+    one is nested in, if it is.
     '''
+    name = '{}.{}'.format(scope, message.name) if scope else message.name
+    nested = {m.name: m for m in message.nested_type}
     args = []
     for f in message.field:
-        if f.type == FieldDescriptorProto.TYPE_MESSAGE:
-            # foo=SomeMessage(...). Need a recursive call to resolve the arguments. 
-            _, _, _, nested_message_name = f.type_name.split('.', maxsplit=3)
-            sys.stderr.write('looking for nested: {}\n'.format(nested_message_name))
-            for nested_message in message.nested_type:
-                sys.stderr.write('Looking at {}\n'.format(nested_message.name))
-                if nested_message.name == nested_message_name:
-                    args.append(message2invocation(nested_message))
+        nested_message = nested.get(f.type_name.split('.')[-1]) if f.type == FieldDescriptorProto.TYPE_MESSAGE else None
+        if f.label == FieldDescriptorProto.LABEL_REPEATED:
+            # Map fields are repeated fields of a generated nested MapEntry message.
+            is_map = nested_message is not None and nested_message.options.map_entry
+            args.append('{}={}'.format(f.name, f.name if not defaults else '{}' if is_map else '[]'))
+        elif nested_message is not None:
+            # foo=pb.Message.Nested(...). Need a recursive call to resolve the arguments. 
+            args.append('{}=pb.{}'.format(f.name, message2invocation(nested_message, defaults, name)))
+        elif not defaults:
+            # foo=foo
+            args.append('{}={}'.format(f.name, f.name))
         else:
-            if not defaults:
-                # foo=foo
-                args.append('{}={}'.format(f.name, f.name))
-            else:
-                # foo=False or foo=None
-                args.append('{}={}'.format(f.name, field2arg_default(f)))
+            # foo=False or foo=None
+            args.append('{}={}'.format(f.name, field2arg_default(f)))
 
-    return '{}({})'.format(message.name, ', '.join(args))
+    return '{}({})'.format(name, ', '.join(args))
 
 def _service_to_filename(service):
     '''Given a service message, generate a string that can be used as a filename (without extension).'''
@@ -154,6 +161,10 @@ def generate_client_python(proto_file, response):
 
         # __init__ simply calls the DistributedAgent base, whcih does most of the work.
         f.content += 'class {}(DistributedAgent):\n'.format(service.name)
+        f.content += '    service = pb.DESCRIPTOR.services_by_name[\'{}\']\n'.format(service.name)
+        # Methods marked idempotent in the proto (option idempotency_level) may be retried and hedged.
+        f.content += '    idempotent = {}\n'.format(_idempotent_methods(service))
+        f.content += '\n'
         f.content += '    def __init__(self, nodes, port=51000):\n'
         f.content += '        super().__init__(nodes, port)\n'
         f.content += '        self.load_agent(\'{}\', pb_grpc.{}Stub)\n'.format(service.name, service.name)
@@ -161,31 +172,81 @@ def generate_client_python(proto_file, response):
 
         # now generate methods calls. They pass off the args to a base class method that does the real work.
         for method in service.method:                   # method is a MethodDescriptorProto instance. 
-            # we have two sets of args to get, one for the kwargs of teh method defination and one for
-            # the actual calling into the base class method.
-            # def foobar(self, one=None, two=0):
-            #     return self.blocking_call(ArgMessage(one=one, two=two)
-            #
-            _, _, in_message_name = method.input_type.split(sep='.', maxsplit=2)
-            in_message = [m for m in proto_file.message_type if m.name == in_message_name][0]
-            _, _, out_message_name = method.output_type.split(sep='.', maxsplit=2)
-            out_message = [m for m in proto_file.message_type if m.name == out_message_name][0]
+            f.content += _client_method(proto_file, method)
 
-            def_args = ['{}={}'.format(f.name, field2arg_default(f)) for f in in_message.field]
-            invoke_args = ['{}={}'.format(f.name, f.name) for f in in_message.field]
-
-            f.content += '    # returns --> pb.{}\n'.format(message2invocation(out_message))
-            f.content += '    def {}({}):\n'.format(method.name, ', '.join(['self'] + def_args))
-            if method.server_streaming:
-                f.content += '       return self.blocking_call_server_streaming(\n'
-            else:
-                f.content += '       return self.blocking_call(\n'
-            f.content += '           \'{}\',\n'.format(method.name)
-            f.content += '           pb.{}({})\n'.format(in_message_name, ', '.join(invoke_args))
-            f.content += '       )\n'
-            f.content += '    \n'
-
-def generate_servicer_python(proto_file, response):
+        # The asyncio version of the same agent. It cannot load itself in __init__ as that 
+        # needs to be awaited, so users call load() instead.
+        f.content += 'class Async{}(AsyncDistributedAgent):\n'.format(service.name)
+        f.content += '    service = pb.DESCRIPTOR.services_by_name[\'{}\']\n'.format(service.name)
+        f.content += '\n'
+        f.content += '    def __init__(self, nodes, port=51000):\n'
+        f.content += '        super().__init__(nodes, port)\n'
+        f.content += '\n'
+        f.content += '    async def load(self):\n'
+        f.content += '        await self.load_agent(\'{}\', pb_grpc.{}Stub)\n'.format(service.name, service.name)
+        f.content += '        return self\n'
+        f.content += '\n'
+        for method in service.method:
+            f.content += _client_method(proto_file, method, asyncio=True)
+
+def _idempotent_methods(service):
+    '''Return the names of the methods of the service that are safe to call more than once.'''
+    levels = [MethodOptions.IDEMPOTENT, MethodOptions.NO_SIDE_EFFECTS]
+    return [m.name for m in service.method if m.options.idempotency_level in levels]
+
+def _client_method(proto_file, method, asyncio=False):
+    '''Return the client-side wrapper of a single method. The wrapper packs the kwargs into
+    the input message and hands it to the base class to call on all nodes.'''
+    # we have two sets of args to get, one for the kwargs of teh method defination and one for
+    # the actual calling into the base class method.
+    # def foobar(self, one=None, two=0):
+    #     return self.blocking_call(ArgMessage(one=one, two=two)
+    #
+    _, _, in_message_name = method.input_type.split(sep='.', maxsplit=2)
+    in_message = [m for m in proto_file.message_type if m.name == in_message_name][0]
+    _, _, out_message_name = method.output_type.split(sep='.', maxsplit=2)
+    out_message = [m for m in proto_file.message_type if m.name == out_message_name][0]
+
+    # call_opts (timeout, completion, ...) are passed through to the base class call. Those named
+    # like a field of the message are given with a leading underscore, as the field has the name.
+    def_args = ['{}={}'.format(f.name, field2arg_default(f)) for f in in_message.field] + ['**call_opts']
+    invoke_args = ['{}={}'.format(f.name, f.name) for f in in_message.field]
+    clashes = [f.name for f in in_message.field if f.name in _call_options]
+
+    content = '    # returns --> pb.{}\n'.format(message2invocation(out_message))
+    if clashes:
+        content += '    # {} {} of {}, so give the call {} as {}.\n'.format(
+            ', '.join(clashes), 'is a field' if len(clashes) == 1 else 'are fields', in_message_name,
+            'option' if len(clashes) == 1 else 'options', ', '.join('_' + c for c in clashes))
+    if not asyncio:
+        content += '    def {}({}):\n'.format(method.name, ', '.join(['self'] + def_args))
+        if method.server_streaming:
+            content += '       return self.blocking_call_server_streaming(\n'
+        else:
+            content += '       return self.blocking_call(\n'
+    else:
+        # streaming methods return an async generator, everything else is awaited.
+        if method.server_streaming:
+            content += '    def {}({}):\n'.format(method.name, ', '.join(['self'] + def_args))
+            content += '       return self.call_server_streaming(\n'
+        else:
+            content += '    async def {}({}):\n'.format(method.name, ', '.join(['self'] + def_args))
+            content += '       return await self.call(\n'
+
+    content += '           \'{}\',\n'.format(method.name)
+    content += '           pb.{}({}),\n'.format(in_message_name, ', '.join(invoke_args))
+    if clashes:
+        content += '           **call_options(call_opts, {})\n'.format(clashes)
+    else:
+        content += '           **call_opts\n'
+    content += '       )\n'
+    content += '    \n'
+    return content
+
+def generate_servicer_python(proto_file, response, asyncio=False):
+    '''Generate servicer templates. If asyncio, the methods are coroutines (and streaming methods 
+    async generators) for agent servers run with --asyncio, where they run on the server's event 
+    loop instead of holding a worker thread for as long as they run.'''
     for service in proto_file.service:
         f = response.file.add()
         filename = _service_to_filename(service)
@@ -215,8 +276,9 @@ def generate_servicer_python(proto_file, response):
             _, _, out_message_name = method.output_type.split(sep='.', maxsplit=2)
             out_message = [m for m in proto_file.message_type if m.name == out_message_name][0]
 
-            f.content += '    # returns pb.{}\n'.format(message2invocation(out_message))
-            f.content += '    def {}(self, request, context):\n'.format(method.name)
+            f.content += '    # {} pb.{}\n'.format('yields' if method.server_streaming else 'returns', 
+                                                message2invocation(out_message))
+            f.content += '    {}def {}(self, request, context):\n'.format('async ' if asyncio else '', method.name)
             f.content += '        log.debug("Invoking: {}(...)")\n'.format(method.name)
             for field in in_message.field:
                 f.content += '        {} = request.{}\n'.format(field.name, field.name)
@@ -225,6 +287,7 @@ def generate_servicer_python(proto_file, response):
                 f.content += '        # Now use the args above to do the actual work of {}.\n'.format(method.name)
                 f.content += '        # Until then, return a success=False response.\n'
 
-            f.content += '        return pb.{}\n'.format(message2invocation(out_message, defaults=True))
+            f.content += '        {} pb.{}\n'.format('yield' if method.server_streaming else 'return',
+                                                message2invocation(out_message, defaults=True))
             f.content += '\n'
 
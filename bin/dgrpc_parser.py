@@ -21,11 +21,14 @@ if __name__ == '__main__':
     # Create response and fill it with python.
     response = plugin.CodeGeneratorResponse()
 
+    # Options are given as --dgrpc_out=opt1,opt2:outdir. "async" generates asyncio servicer templates.
+    options = request.parameter.split(',') if request.parameter else []
+
     # generate client and service-stub files in python.
     for proto_file in request.proto_file:
         log.info('Parsing proto file {}'.format(proto_file.name))
         generate_client_python(proto_file, response)
-        generate_servicer_python(proto_file, response)
+        generate_servicer_python(proto_file, response, asyncio='async' in options)
         
     # Serialize response message
     output = response.SerializeToString()
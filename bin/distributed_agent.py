@@ -1,25 +1,679 @@
+import asyncio
 import logging
 import grpc
+import math
+import os
+import random
+import socket
+import stat
 import sys
+import time
+from array import array
 from concurrent import futures
-from threading import Thread, Lock
-from queue import Queue
+from functools import lru_cache
+from itertools import compress
+from threading import Thread, Lock, Event
+from queue import Queue, Empty
 
 from . import agent_server_pb2_grpc as pb_grpc
 from . import agent_server_pb2 as pb
 
+from google.protobuf.message import Message
+
+try:
+    from google.protobuf.message_factory import GetMessageClass
+except ImportError:
+    # protobuf < 4.21
+    from google.protobuf import symbol_database
+
+    def GetMessageClass(descriptor):
+        return symbol_database.Default().GetSymbol(descriptor.full_name)
+
 log = logging.getLogger(__name__)
 
 class DistributedAgentException(Exception):
     pass
 
+class _DeadlineExceeded(Exception):
+    pass
+
+# Marks the end of a node's stream in blocking_call_server_streaming().
+_END_OF_STREAM = object()
+
+def per_node_args(args, per_node, node):
+    '''Return the args to send to node. per_node is either a dict keyed by node or a callable that
+    takes the node name. Either gives, for a node, a complete args message to send instead of args,
+    a dict of field values that replace those fields in args, or None to send args as is:
+
+        # capture to a different file on each node.
+        tcpdump.Configure(agentlog='/tmp/tcpdump_agent.log',
+                          per_node=lambda n: {'dumpfile': '/tmp/{}.cap'.format(n)})
+    '''
+    if per_node is None:
+        return args
+
+    node_args = per_node(node) if callable(per_node) else per_node.get(node)
+    if node_args is None:
+        return args
+
+    if isinstance(node_args, Message):
+        return node_args
+
+    merged = type(args)()
+    merged.CopyFrom(args)
+    for field in node_args:
+        merged.ClearField(field)
+
+    merged.MergeFrom(type(args)(**node_args))
+    return merged
+
+class Completion:
+    '''When blocking_call() stops waiting for nodes and how its responses judge success().
+        ALL - wait for every node (or the timeout). Success if all nodes succeeded.
+        QUORUM - return once a majority of nodes succeeded (or that can no longer happen).
+        FIRST - return once the first count nodes succeeded (or that can no longer happen).
+        BEST_EFFORT - wait for every node until the timeout. Success if every node that 
+            answered succeeded; nodes that timed out do not count against it.
+    '''
+    ALL = 'all'
+    QUORUM = 'quorum'
+    FIRST = 'first'
+    BEST_EFFORT = 'best_effort'
+
+class Readiness:
+    '''The state of an agent's dependencies on a node, as reported by DistributedAgent.readiness().'''
+    NOT_INSTALLED = 'not installed'
+    INSTALLING = 'installing'
+    READY = 'ready'
+    FAILED = 'failed'
+
+class RetryPolicy:
+    '''Retry a call on a node that failed with one of codes, at most max_attempts times in all.
+    Attempt n waits a random time up to initial_backoff * multiplier**(n-1), capped at max_backoff,
+    so retries from many nodes do not all land at once. Retries stop at the call's deadline. A
+    stream is only retried if it failed before its first message.'''
+    def __init__(self, max_attempts=3, initial_backoff=0.1, max_backoff=5.0, multiplier=2.0, codes=None):
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.multiplier = multiplier
+        self.codes = codes if codes is not None else [grpc.StatusCode.UNAVAILABLE]
+
+    def retryable(self, error, attempt):
+        '''True if a call that failed with the RpcError error on the given attempt (1 is the first)
+        should be tried again.'''
+        return attempt < self.max_attempts and error.code() in self.codes
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.initial_backoff * self.multiplier ** (attempt - 1)))
+
+class HedgePolicy:
+    '''If a node has not answered a unary call after a delay, send it the same request again (up
+    to max_hedges more times) and keep whichever answer comes first. The delay is delay seconds
+    if given, else the given percentile of the method's latency across all nodes (see
+    LatencyStats), once there are at least min_samples of them. The delay is never less than
+    min_delay. At most budget (a fraction) of the nodes in a call are hedged, so a slow fan-out
+    cannot double the load on the daemons.'''
+    def __init__(self, percentile=95, delay=None, min_delay=0.01, min_samples=20, max_hedges=1, budget=0.1):
+        self.percentile = percentile
+        self.delay = delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.max_hedges = max_hedges
+        self.budget = budget
+
+    def hedge_delay(self, latency, key):
+        '''Return the delay before hedging a call of method key, or None to not hedge.'''
+        if self.delay is not None:
+            return max(self.delay, self.min_delay)
+
+        h = latency.method_histogram(key)
+        if h.count < self.min_samples:
+            return None
+
+        return max(h.percentile(self.percentile), self.min_delay)
+
+class _HedgeBudget:
+    '''The number of hedged requests left in a single fan-out.'''
+    def __init__(self, count):
+        self._lock = Lock()
+        self._count = count
+
+    def take(self):
+        with self._lock:
+            if self._count <= 0:
+                return False
+
+            self._count -= 1
+            return True
+
+class _InFlight:
+    '''The grpc futures of one fan-out's calls that have not finished. cancel() ends them, and any
+    started after it, so calls the fan-out no longer waits for do not hold the shared executor's
+    threads until they answer.'''
+    def __init__(self):
+        self._lock = Lock()
+        self._futures = set()
+        self.cancelled = Event()
+
+    def result(self, f):
+        '''Wait for and return the result of the grpc future f, as the blocking call would.'''
+        self.add(f)
+        try:
+            return f.result()
+        finally:
+            with self._lock:
+                self._futures.discard(f)
+
+    def add(self, f):
+        with self._lock:
+            if not self.cancelled.is_set():
+                self._futures.add(f)
+                return
+
+        f.cancel()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled.set()
+            running, self._futures = self._futures, set()
+
+        for f in running:
+            f.cancel()
+
+def call_options(call_opts, names):
+    '''Return the call options given to a generated agent method whose message has fields with
+    the given names of call options. As the fields have those names, the call options are given
+    with a leading underscore instead, i.e. _timeout.'''
+    opts = dict(call_opts)
+    for name in names:
+        if '_' + name in opts:
+            opts[name] = opts.pop('_' + name)
+
+    return opts
+
+def relay_tree(nodes, fanout):
+    '''Split nodes into at most fanout subtrees of (nearly) equal size. Returns a list of 
+    (head, subtree) tuples; head is called directly and relays the call on to the nodes 
+    in subtree, which it splits the same way.'''
+    nodes = list(nodes)
+    if not nodes:
+        return []
+
+    fanout = max(1, min(fanout, len(nodes)))
+    size, extra = divmod(len(nodes), fanout)
+    tree = []
+    start = 0
+    for i in range(fanout):
+        end = start + size + (1 if i < extra else 0)
+        tree.append((nodes[start], nodes[start+1:end]))
+        start = end
+
+    return tree
+
+def method_key(path):
+    '''Return the Service.Method name used in LatencyStats for a grpc method path.'''
+    service, method = path.lstrip('/').split('/')
+    return '{}.{}'.format(service.split('.')[-1], method)
+
+@lru_cache(maxsize=None)
+def is_local_node(node):
+    '''True if the node name resolves to an address of this host.'''
+    try:
+        addrs = {ai[4][0] for ai in socket.getaddrinfo(node, None, proto=socket.IPPROTO_TCP)}
+    except socket.gaierror:
+        return False
+
+    # Only addresses of this host can be bound to.
+    for addr in addrs:
+        with socket.socket(socket.AF_INET6 if ':' in addr else socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            try:
+                sock.bind((addr, 0))
+                return True
+            except OSError:
+                continue
+
+    return False
+
+class LatencyHistogram:
+    '''Latencies, in seconds, counted in log scale buckets. Each power of two is split into
+    sub_buckets buckets, so a bucket is never wider than 1/sub_buckets of the values in it and
+    percentiles are within that of the real value. Only buckets that have been hit are stored,
+    so a histogram is a handful of dict entries, and recording a latency is a frexp() and a
+    dict update.'''
+    __slots__ = ('buckets', 'count', 'errors', 'total', 'min', 'max')
+    sub_buckets = 16
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds, error=False):
+        '''Count one call that took seconds. error says it did not succeed.'''
+        # seconds = mantissa * 2**exp with 0.5 <= mantissa < 1
+        mantissa, exp = math.frexp(max(seconds, 1e-9))
+        bucket = exp * self.sub_buckets + int((mantissa - 0.5) * 2 * self.sub_buckets)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.errors += error
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def _value(self, bucket):
+        '''The middle of the bucket, in seconds.'''
+        exp, sub = divmod(bucket, self.sub_buckets)
+        return math.ldexp(0.5 + (sub + 0.5) / (2 * self.sub_buckets), exp)
+
+    def merge(self, other):
+        '''Add the counts of other to this histogram.'''
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+        self.count += other.count
+        self.errors += other.errors
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+        return self
+
+    def percentile(self, p):
+        '''Return the latency below which p percent of the calls fell, or None if there are none.'''
+        if not self.count:
+            return None
+
+        target = max(1, math.ceil(self.count * p / 100))
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min(max(self._value(bucket), self.min), self.max)
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def summary(self):
+        return {'count': self.count, 'errors': self.errors, 'mean': self.mean(), 'min': self.min,
+                'max': self.max, 'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99)}
+
+    def to_pb(self):
+        '''Return the histogram as a StatsResponse.Histogram.'''
+        buckets = sorted(self.buckets)
+        return pb.StatsResponse.Histogram(
+            buckets=buckets, counts=[self.buckets[b] for b in buckets], sub_buckets=self.sub_buckets,
+            count=self.count, errors=self.errors, total=self.total, 
+            min=self.min if self.min is not None else 0.0, max=self.max if self.max is not None else 0.0)
+
+    @classmethod
+    def from_pb(cls, msg):
+        '''Return the LatencyHistogram of a StatsResponse.Histogram, i.e. to merge() those of many nodes.'''
+        h = cls()
+        if msg.sub_buckets and msg.sub_buckets != h.sub_buckets:
+            raise ValueError('Histogram has {} sub buckets, not {}'.format(msg.sub_buckets, h.sub_buckets))
+
+        h.buckets = dict(zip(msg.buckets, msg.counts))
+        h.count = msg.count
+        h.errors = msg.errors
+        h.total = msg.total
+        if msg.count:
+            h.min = msg.min
+            h.max = msg.max
+
+        return h
+
+class LatencyStats:
+    '''Latency histograms of calls made by the agents, one per node and method. Methods are named
+    Service.Method, i.e. TcpdumpAgent.Configure. The load of an agent is AgentServer.Load. For
+    streaming methods the time to the first message is recorded. Shared by all agents as
+    DistributedAgent.latency:
+
+        responses = tcpdump.Configure(dumpfile='/tmp/tcpdump.cap')
+        print(DistributedAgent.latency.slowest('TcpdumpAgent.Configure'))
+        DistributedAgent.latency.start_dump(60)    # log a summary every minute.
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self._histograms = {}
+        self._dump_thread = None
+        self._dump_stop = Event()
+        # Set to False to record nothing.
+        self.enabled = True
+
+    def record(self, node, method, seconds, error=False):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            h = self._histograms.get((node, method))
+            if h is None:
+                h = self._histograms[(node, method)] = LatencyHistogram()
+
+            h.record(seconds, error)
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    def histogram(self, node, method):
+        '''Return the histogram for method on node, or None if it has not been called there.'''
+        return self._histograms.get((node, method))
+
+    def methods(self):
+        return sorted(set(m for _, m in list(self._histograms)))
+
+    def nodes(self, method=None):
+        return sorted(set(n for n, m in list(self._histograms) if method is None or m == method))
+
+    def method_histogram(self, method):
+        '''Return a histogram of method's latency across all nodes.'''
+        merged = LatencyHistogram()
+        with self._lock:
+            for (_, m), h in self._histograms.items():
+                if m == method:
+                    merged.merge(h)
+
+        return merged
+
+    def summary(self, node=None, method=None):
+        '''Return {(node, method): summary dict} for the given node and/or method, or all of them.'''
+        with self._lock:
+            return {k: h.summary() for k, h in self._histograms.items()
+                    if (node is None or k[0] == node) and (method is None or k[1] == method)}
+
+    def slowest(self, method, percentile=99, count=10):
+        '''Return [(node, latency)] of the count nodes with the highest given percentile latency
+        for method, slowest first.'''
+        with self._lock:
+            latencies = [(n, h.percentile(percentile)) for (n, m), h in self._histograms.items() if m == method]
+
+        return sorted(latencies, key=lambda l: l[1], reverse=True)[:count]
+
+    def dump(self, level=logging.INFO):
+        '''Log a summary of each method across all nodes and its slowest nodes.'''
+        for method in self.methods():
+            s = self.method_histogram(method).summary()
+            log.log(level, '{}: {} calls, {} errors, mean {:.4f}s p50 {:.4f}s p90 {:.4f}s p99 {:.4f}s max {:.4f}s'.format(
+                method, s['count'], s['errors'], s['mean'], s['p50'], s['p90'], s['p99'], s['max']))
+            slowest = ', '.join('{}={:.4f}s'.format(n, l) for n, l in self.slowest(method, count=5))
+            log.log(level, '{}: slowest p99: {}'.format(method, slowest))
+
+    def start_dump(self, interval=60, level=logging.INFO, reset=False):
+        '''Call dump() every interval seconds from a background thread. If reset, the histograms
+        are cleared after each dump so each one covers only the last interval.'''
+        self.stop_dump()
+        self._dump_stop.clear()
+
+        def dumper():
+            while not self._dump_stop.wait(interval):
+                self.dump(level)
+                if reset:
+                    self.reset()
+
+        self._dump_thread = Thread(target=dumper, name='dgrpc-latency', daemon=True)
+        self._dump_thread.start()
+
+    def stop_dump(self):
+        if self._dump_thread:
+            self._dump_stop.set()
+            self._dump_thread.join()
+            self._dump_thread = None
+
+class DistributedAgentChannels:
+    '''Channels to the agent servers on the nodes, shared by every agent in the process. There is
+    one channel, and so one HTTP/2 connection, per node and port no matter how many agents use it. 
+    Channels are reference counted and only closed when the last agent using one lets it go. 
+    
+    The connectivity state of each channel is watched from the moment it is created, which also 
+    starts connecting right away, so nodes that cannot be reached are known before any call is 
+    made to them.
+
+    The agents Loaded on each node are remembered, so creating another agent of the same type
+    does not Load it again. A node forgets its agents whenever its channel drops, as the daemon
+    may have been restarted.
+    '''
+    # Keepalive pings find dead connections (i.e. a node that was swapped out) without waiting on
+    # a call to time out. The agent server permits pings this often.
+    options = [
+        ('grpc.keepalive_time_ms', 30000),
+        ('grpc.keepalive_timeout_ms', 10000),
+        ('grpc.keepalive_permit_without_calls', 1),
+        ('grpc.http2.max_pings_without_data', 0),
+        ('grpc.initial_reconnect_backoff_ms', 1000),
+        ('grpc.max_reconnect_backoff_ms', 30000),
+        ('grpc.max_send_message_length', 64 * 1024 * 1024),
+        ('grpc.max_receive_message_length', 64 * 1024 * 1024),
+    ]
+    # i.e. grpc.Compression.Gzip to compress all calls. 
+    compression = None
+    # The unix socket an agent server on this host listens on (see agent_server.py --unix-socket),
+    # by port. It is used rather than TCP for nodes that are this host. None to always use TCP.
+    unix_socket = '/run/dgrpc/agent_server-{port}.sock'
+
+    @classmethod
+    def target(cls, node, port):
+        '''Return the address to reach the agent server on the node at.'''
+        if cls.unix_socket:
+            sock = cls.unix_socket.format(port=port)
+            try:
+                serving = stat.S_ISSOCK(os.stat(sock).st_mode)
+            except OSError:
+                serving = False
+
+            if serving and is_local_node(node):
+                return 'unix:{}'.format(sock)
+
+        return '{}:{}'.format(node, port)
+
+    def __init__(self):
+        self._lock = Lock()
+        self._channels = {}
+        self._server_agents = {}
+        self._refs = {}
+        self._states = {}
+        # (node, port) -> names of agents Loaded there.
+        self._loaded = {}
+
+    def acquire(self, node, port):
+        '''Return (channel, created) for the node, taking a reference to it. created is True
+        if there was no open channel to the node.'''
+        key = (node, port)
+        with self._lock:
+            created = not key in self._channels
+            if created:
+                channel = grpc.insecure_channel(self.target(node, port), options=self.options,
+                                                compression=self.compression)
+                self._channels[key] = channel
+                self._server_agents[key] = pb_grpc.AgentServerStub(channel)
+                self._refs[key] = 0
+                self._states[key] = grpc.ChannelConnectivity.IDLE
+                channel.subscribe(lambda state, key=key: self._watch(key, state), try_to_connect=True)
+
+            self._refs[key] += 1
+            return self._channels[key], created
+
+    def release(self, node, port):
+        '''Drop a reference to the node's channel, closing it if this was the last one.'''
+        key = (node, port)
+        with self._lock:
+            if not key in self._refs:
+                return
+
+            self._refs[key] -= 1
+            if self._refs[key] > 0:
+                return
+
+            channel = self._channels.pop(key)
+            del self._server_agents[key]
+            del self._refs[key]
+            del self._states[key]
+            self._loaded.pop(key, None)
+
+        log.debug('closing channel to {}:{}'.format(node, port))
+        channel.close()
+
+    def _watch(self, key, state):
+        # Called on a grpc thread, alongside set_loaded() and release().
+        with self._lock:
+            if not key in self._states:
+                # released since.
+                return
+
+            if state != self._states[key]:
+                log.debug('channel to {}:{} is {}'.format(key[0], key[1], state))
+
+            if state != grpc.ChannelConnectivity.READY and self._loaded.pop(key, None):
+                log.debug('forgetting agents loaded on {}:{}'.format(key[0], key[1]))
+
+            self._states[key] = state
+
+    def channel(self, node, port):
+        return self._channels[(node, port)]
+
+    def loaded(self, node, port, name):
+        '''True if the agent name is known to be loaded on the node.'''
+        return name in self._loaded.get((node, port), ())
+
+    def set_loaded(self, node, port, name, loaded=True):
+        with self._lock:
+            if not loaded:
+                self._loaded.get((node, port), set()).discard(name)
+            elif (node, port) in self._channels:
+                self._loaded.setdefault((node, port), set()).add(name)
+
+    def server_agent(self, node, port):
+        '''Return the AgentServer stub for the node.'''
+        return self._server_agents[(node, port)]
+
+    def state(self, node, port):
+        '''Return the grpc.ChannelConnectivity of the node's channel, or None if there is none.'''
+        return self._states.get((node, port))
+
+    def unreachable(self, node, port):
+        return self.state(node, port) in [grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+                                          grpc.ChannelConnectivity.SHUTDOWN]
+
+    def wait_for_ready(self, nodes, port, timeout):
+        '''Wait up to timeout seconds for the channels to all nodes to connect. Returns the 
+        nodes that did not.'''
+        waits = {grpc.channel_ready_future(self._channels[(n, port)]): n for n in nodes}
+        deadline = time.monotonic() + timeout
+        not_ready = []
+        for f, n in waits.items():
+            try:
+                f.result(timeout=max(0, deadline - time.monotonic()))
+            except grpc.FutureTimeoutError:
+                f.cancel()
+                not_ready.append(n)
+
+        return not_ready
+
+class AsyncDistributedAgentChannels(DistributedAgentChannels):
+    '''DistributedAgentChannels of grpc.aio channels, for the async agents. They are reference
+    counted and forget the agents Loaded on a node when its channel drops, in the same way. Must
+    be used from the event loop the channels are used on. release() is a coroutine here.'''
+    def __init__(self):
+        super().__init__()
+        # (node, port) -> task watching the channel's connectivity state.
+        self._watchers = {}
+
+    def acquire(self, node, port):
+        key = (node, port)
+        created = not key in self._channels
+        if created:
+            channel = grpc.aio.insecure_channel(self.target(node, port), options=self.options,
+                                                compression=self.compression)
+            self._channels[key] = channel
+            self._server_agents[key] = pb_grpc.AgentServerStub(channel)
+            self._refs[key] = 0
+            self._states[key] = grpc.ChannelConnectivity.IDLE
+            self._watchers[key] = asyncio.ensure_future(self._watch_state(key, channel))
+
+        self._refs[key] += 1
+        return self._channels[key], created
+
+    async def release(self, node, port):
+        key = (node, port)
+        if not key in self._refs:
+            return
+
+        self._refs[key] -= 1
+        if self._refs[key] > 0:
+            return
+
+        channel = self._channels.pop(key)
+        del self._server_agents[key]
+        del self._refs[key]
+        del self._states[key]
+        self._loaded.pop(key, None)
+        self._watchers.pop(key).cancel()
+
+        log.debug('closing channel to {}:{}'.format(node, port))
+        await channel.close()
+
+    async def _watch_state(self, key, channel):
+        # aio channels have no subscribe(), so wait on each change of state in turn.
+        state = channel.get_state(try_to_connect=True)
+        while True:
+            self._watch(key, state)
+            await channel.wait_for_state_change(state)
+            state = channel.get_state()
+
+class _NodeStub:
+    '''The client stub of an agent on one node. The channel to the node is only opened the
+    first time a method is used, so nodes that are only ever reached through relays are not
+    connected to.'''
+    def __init__(self, agent, node, agent_stub):
+        self._agent = agent
+        self._node = node
+        self._agent_stub = agent_stub
+        self._stub = None
+
+    def __getattr__(self, name):
+        if self._stub is None:
+            self._stub = self._agent_stub(self._agent._acquire(self._node))
+
+        return getattr(self._stub, name)
+
 class DistributedAgent:
     # These are "singleton" data instances used by all derivrd classes. No need for each
     # agent instance to have it's own open channel to the services. 
-    # Communication with services.
-    _channels = {}
-    # command and control of meta-agent tasks.
-    _server_agents = {}
+    _channels = DistributedAgentChannels()
+    # If set, load_agent() waits this many seconds for all nodes to connect and fails if any
+    # do not, rather than finding out at call time.
+    connect_timeout = None
+    # Thread pool shared by all agents for fanning calls out to nodes. It is created on first
+    # use and lives for the life of the process. max_workers caps the number of RPCs in flight
+    # at once, so calls to large node sets go out in windows of at most max_workers nodes.
+    _executor = None
+    _executor_lock = Lock()
+    max_workers = 64
+    # If non-zero, unary calls are made on at most relay_fanout nodes, which relay the call
+    # through the daemons on the remaining nodes in a relay_fanout-ary tree. Zero calls 
+    # every node directly.
+    relay_fanout = 0
+    # Max number of undelivered messages held per node by blocking_call_server_streaming().
+    stream_buffer = 16
+    # The service descriptor of the agent. Set by the generated agent classes.
+    service = None
+    # Per node, per method latencies of all calls. See LatencyStats.
+    latency = LatencyStats()
+    # Names of the methods that are safe to call more than once, and so may be retried and hedged.
+    # Set by the generated agent classes from the idempotency_level of the methods in the proto.
+    idempotent = []
+    # The RetryPolicy and HedgePolicy used for idempotent methods that do not have their own (see
+    # set_call_policy()). None means no retries or no hedging.
+    retry_policy = None
+    hedge_policy = None
 
     def __init__(self, nodes, port):
         self.port = port
@@ -27,44 +681,137 @@ class DistributedAgent:
 
         # agents created by users
         self.agents = {}
+        self._agent_name = None
+        # nodes we hold a channel reference to.
+        self._acquired = set()
+        self._acquire_lock = Lock()
+
+        # defaults for blocking_call(). See there.
+        self.timeout = None
+        self.completion = Completion.ALL
+        # (retry, hedge) policies by method name.
+        self._call_policies = {}
+
+    @classmethod
+    def set_max_workers(cls, max_workers):
+        '''Set the number of concurrent RPCs allowed across all agents. Takes effect on the next call.'''
+        if max_workers < 1:
+            raise DistributedAgentException('max_workers must be at least 1, not {}'.format(max_workers))
+
+        with DistributedAgent._executor_lock:
+            DistributedAgent.max_workers = max_workers
+            if DistributedAgent._executor:
+                # in flight calls still complete, new calls go to the new executor.
+                DistributedAgent._executor.shutdown(wait=False)
+                DistributedAgent._executor = None
+
+    @classmethod
+    def _get_executor(cls):
+        '''Return the shared executor, creating it if needed.'''
+        with DistributedAgent._executor_lock:
+            if not DistributedAgent._executor:
+                DistributedAgent._executor = futures.ThreadPoolExecutor(
+                    max_workers=DistributedAgent.max_workers, thread_name_prefix='dgrpc')
+
+            return DistributedAgent._executor
+
+    @classmethod
+    def set_relay_fanout(cls, fanout):
+        '''Relay calls to all agents created after this through a fanout-ary tree of daemons. 
+        Zero (the default) turns relaying off. Can also be set on a single agent instance via 
+        agent.relay_fanout.'''
+        if fanout < 0:
+            raise DistributedAgentException('relay fanout cannot be negative.')
+
+        DistributedAgent.relay_fanout = fanout
+
+    def set_call_policy(self, method, retry=None, hedge=None):
+        '''Retry and/or hedge calls to method on this agent with the given RetryPolicy and
+        HedgePolicy. Only methods marked idempotent in the proto can be given a policy:
+
+            tcpdump.set_call_policy('Configure', retry=RetryPolicy(), hedge=HedgePolicy(percentile=90))
+        '''
+        if not method in self.idempotent:
+            raise DistributedAgentException('{} is not marked idempotent in the {} proto, so it cannot '
+                                            'be retried or hedged.'.format(method, self._agent_name))
+
+        self._call_policies[method] = (retry, hedge)
+
+    def _call_policy(self, method, retry, hedge):
+        '''Return the (retry, hedge) policies to use for a call of method. retry and hedge are the
+        policies given to the call, if any. False turns a policy off for the call.'''
+        if not method in self.idempotent:
+            if retry or hedge:
+                raise DistributedAgentException('{} is not marked idempotent in the {} proto, so it '
+                                                'cannot be retried or hedged.'.format(method, self._agent_name))
+            return None, None
+
+        default_retry, default_hedge = self._call_policies.get(method, (self.retry_policy, self.hedge_policy))
+        retry = default_retry if retry is None else retry
+        hedge = default_hedge if hedge is None else hedge
+        return retry or None, hedge or None
 
     def load_agent(self, name, agent_stub):
         '''Takes a reference to a agent stub (client stub) class and creates channels to all 
         referenced nodes, creating instances of that class in self.agents{}. Also loads the
         agent's servicer in the remote daemon and installes the agent dependencies.'''
 
-        # open all channels, create agent_server client-side stubs, and Load() the agent on the server.
+        # open the channels, create agent_server client-side stubs, and Load() the agent on the server.
+        # When relaying, only the heads of the tree are connected to now. Other nodes are
+        # connected to on first direct use, if there is one.
         log.info('Loading {}'.format(name))
+        self._agent_name = name
         try:
             load_calls = {}
-            with futures.ThreadPoolExecutor(len(self.nodes)) as fte:
-                for n in self.nodes:
-                    if not n in DistributedAgent._channels:
-                        DistributedAgent._channels[n] = grpc.insecure_channel('{}:{}'.format(n, self.port))
-                        DistributedAgent._server_agents[n] = pb_grpc.AgentServerStub(DistributedAgent._channels[n])
-                        
-                        # submit calls to Load the server-soide agent to the future.
-                        # The future call maps to the node name.
-                        load_calls[fte.submit(DistributedAgent._server_agents[n].Load, pb.AgentConfig(name=name))] = n
-
-                for f in futures.as_completed(load_calls):
-                    n = load_calls[f]
-                    response = f.result()
-                    if not response.success:
-                        raise DistributedAgentException(
-                            'Error loading {} on node {}: {}'.format(name, n, response.comment))
+            fte = self._get_executor()
+            if self.relay_fanout:
+                direct = [head for head, _ in relay_tree(self.nodes, self.relay_fanout)]
+            else:
+                direct = self.nodes
+
+            for n in direct:
+                self._acquire(n)
+
+            load_nodes = [n for n in self.nodes if not DistributedAgent._channels.loaded(n, self.port, name)]
+            if self.connect_timeout is not None:
+                not_ready = DistributedAgent._channels.wait_for_ready(direct, self.port, self.connect_timeout)
+                if not_ready:
+                    raise DistributedAgentException('Unable to connect to {}'.format(', '.join(not_ready)))
+
+            if self.relay_fanout:
+                path = '/{}/Load'.format(pb.DESCRIPTOR.services_by_name['AgentServer'].full_name)
+                loaded = self._relay_call(path, pb.AgentConfig(name=name), pb.Response, load_nodes)
+            else:
+                for n in load_nodes:
+                    # submit calls to Load the server-soide agent to the future.
+                    # The future call maps to the node name.
+                    load_calls[fte.submit(self._call_node, n, 'AgentServer.Load', self._server_agent(n).Load,
+                                          pb.AgentConfig(name=name), None)] = n
+
+                loaded = ((load_calls[f], f.result(), None, False) for f in futures.as_completed(load_calls))
+
+            for n, response, error, _ in loaded:
+                if error:
+                    raise DistributedAgentException('Error loading {} on node {}: {}'.format(name, n, error))
+
+                if not response.success:
+                    raise DistributedAgentException(
+                        'Error loading {} on node {}: {}'.format(name, n, response.comment))
+
+                DistributedAgent._channels.set_loaded(n, self.port, name)
 
         # GTL TODO: figure out what the proper thing to catch here is.
         except Exception as e:
             msg = 'Error: {}'.format(e)
             log.critical(msg)
+            self.close()
             raise DistributedAgentException(msg)
 
         # Now that the agents are loaded remotely create the client-side stub agent we'll use 
         # to talk to the server-side agent.
         try:
             for n in self.nodes:
-                self.agents[n] = agent_stub(DistributedAgent._channels[n])
+                self.agents[n] = _NodeStub(self, n, agent_stub)
         except Exception as e:
             msg = 'Error creating agent client stub: {}'.format(e)
             log.critical(msg)
@@ -80,125 +827,932 @@ class DistributedAgent:
             del agent
             self.agents[node] = None
 
-        for node, channel in DistributedAgent._channels.items():
-            del channel
-            DistributedAgent._channels[node] = None
+        # Channels are closed once no other agent is using them.
+        with self._acquire_lock:
+            acquired, self._acquired = self._acquired, set()
+
+        for node in acquired:
+            DistributedAgent._channels.release(node, self.port)
+
+    def _acquire(self, node):
+        '''Return the channel to node, taking this agent's reference to it on first use.'''
+        with self._acquire_lock:
+            if not node in self._acquired:
+                DistributedAgent._channels.acquire(node, self.port)
+                self._acquired.add(node)
+
+            return DistributedAgent._channels.channel(node, self.port)
+
+    def _server_agent(self, node):
+        self._acquire(node)
+        return DistributedAgent._channels.server_agent(node, self.port)
+
+    def reload(self):
+        '''Load this agent again on all nodes. The daemons import the agent's module again and 
+        replace the running servicer with the new one, without restarting.'''
+        return self._agent_server_call('Load', pb.AgentConfig(name=self._agent_name, reload=True))
+
+    def unload(self):
+        '''Remove this agent from the daemons on all nodes. Calls to it fail until it is loaded
+        again, by this or a new agent.'''
+        responses = self._agent_server_call('Unload', pb.AgentConfig(name=self._agent_name))
+        for n in self.nodes:
+            DistributedAgent._channels.set_loaded(n, self.port, self._agent_name, False)
+
+        return responses
+
+    def _agent_server_call(self, method, args):
+        '''Call the AgentServer method on all nodes and return the responses.'''
+        responses = DistributedAgentResponses()
+        if self.relay_fanout:
+            path = '/{}/{}'.format(pb.DESCRIPTOR.services_by_name['AgentServer'].full_name, method)
+            for n, r, error, timed_out in self._relay_call(path, args, pb.Response, self.nodes):
+                if error:
+                    responses.add_error(n, error, timed_out)
+                else:
+                    responses.add(n, r)
+
+            return responses
+
+        tpe = self._get_executor()
+        calls = {tpe.submit(self._call_node, n, 'AgentServer.{}'.format(method),
+                            getattr(self._server_agent(n), method), args, None): n for n in self.nodes}
+        for f in futures.as_completed(calls):
+            try:
+                responses.add(calls[f], f.result())
+            except grpc.RpcError as e:
+                log.error('RPC error on {}: {}'.format(calls[f], e))
+                responses.add_error(calls[f], e.details())
+
+        return responses
+
+    def readiness(self, names=None, timeout=None):
+        '''Return {node: {agent name: (state, comment)}} of the dependencies of the given agents
+        (default all) on each node. state is a Readiness value. Nodes that could not be asked map
+        to None. Daemons install preloaded dependencies in the background after starting, and 
+        load_agent() waits for them, so this shows how far along a fresh node is.'''
+        tpe = self._get_executor()
+        calls = {tpe.submit(self._server_agent(n).Readiness, pb.ReadinessArgs(names=names), timeout=timeout): n
+                 for n in self.nodes}
+        readiness = {}
+        for f in futures.as_completed(calls):
+            try:
+                readiness[calls[f]] = {a.name: (a.state, a.comment) for a in f.result().agents}
+            except grpc.RpcError as e:
+                log.error('Unable to get readiness of {}: {}'.format(calls[f], e.details()))
+                readiness[calls[f]] = None
+
+        return readiness
+
+    def stats(self, reset=False, timeout=None):
+        '''Return {node: StatsResponse} of the agent server on each node: how busy it is, how long
+        calls to it wait for a thread and how long each method takes there. Nodes that could not
+        be asked map to None. If reset, each daemon starts counting afresh. With --workers, the
+        stats are of the worker that answered.
 
-    def blocking_call(self, method, args):
+            for node, stats in agent.stats().items():
+                for m in stats.methods:
+                    print(node, m.method, LatencyHistogram.from_pb(m.latency).summary())
+        '''
+        tpe = self._get_executor()
+        calls = {tpe.submit(self._server_agent(n).Stats, pb.StatsArgs(reset=reset), timeout=timeout): n
+                 for n in self.nodes}
+        stats = {}
+        for f in futures.as_completed(calls):
+            try:
+                stats[calls[f]] = f.result()
+            except grpc.RpcError as e:
+                log.error('Unable to get stats of {}: {}'.format(calls[f], e.details()))
+                stats[calls[f]] = None
+
+        return stats
+
+    def unreachable(self):
+        '''Return the nodes whose agent servers cannot currently be reached.'''
+        return [n for n in self.nodes if DistributedAgent._channels.unreachable(n, self.port)]
+
+    def blocking_call(self, method, args, timeout=None, completion=None, count=None, per_node=None,
+                      retry=None, hedge=None):
         '''
             Call the given method with the given args for each agent in turn. Return all response once
             all agents have responded.
                 arg method is a string that is the method to call.
                 arg args is a protbuf class instance that holds the args.
+                arg timeout is the deadline, in seconds, for the whole call. Nodes that have not 
+                    answered by then are marked as timed out in the responses.
+                arg completion is one of the Completion values and says when to stop waiting. 
+                arg count is the number of nodes to wait for with Completion.FIRST.
+                arg per_node gives different args to some or all nodes. See per_node_args().
+                arg retry and hedge are the RetryPolicy and HedgePolicy for this call. See 
+                    set_call_policy(). They do not apply to relayed calls.
+            timeout and completion default to self.timeout and self.completion.
 
-            Calls to all nodes will happend concurrently. 
-            blocking_call will only return once all nodes have responded.
+            Calls to all nodes will happend concurrently, at most max_workers at a time.
+            With Completion.ALL, blocking_call will only return once all nodes have responded
+            or the timeout has passed. RPC errors on a node are recorded in the responses and
+            do not stop the collection of the other nodes' responses.
         '''
-        responses = DistributedAgentResponses()
-        future_responses = {}
-        calls = {}
-        with futures.ThreadPoolExecutor(len(self.agents)) as tpe:
+        timeout = self.timeout if timeout is None else timeout
+        completion = self.completion if completion is None else completion
+        deadline = None if not timeout else time.monotonic() + timeout
+        key = '{}.{}'.format(self._agent_name, method)
+        responses = DistributedAgentResponses(**self._completion_args(completion, count))
+
+        def add(node, r, error=None, timed_out=False):
+            if error:
+                log.debug('{}: {}() --> {}'.format(node.split('.')[0], method, error))
+                responses.add_error(node, error, timed_out)
+            else:
+                comment = '' if not r.comment else ': {}'.format(r.comment)
+                log.debug('{}: {}() --> {}{}'.format(node.split('.')[0], method, r.success, comment))
+                responses.add(node, r)
+
+        if self.relay_fanout:
+            path, response_class = self._method_info(method, args)
+            for node, r, error, timed_out in self._relay_call(path, args, response_class, self.agents.keys(), 
+                                                              timeout, per_node):
+                add(node, r, error, timed_out)
+                if responses.decided(len(self.agents)):
+                    break
+        else:
+            retry, hedge = self._call_policy(method, retry, hedge)
+            if hedge:
+                delay = hedge.hedge_delay(self.latency, key)
+                budget = _HedgeBudget(max(1, int(len(self.agents) * hedge.budget)))
+                hedge = (delay, hedge.max_hedges, budget) if delay is not None else None
+
+            calls = {}
+            inflight = _InFlight()
+            tpe = self._get_executor()
             for node, agent in self.agents.items():
                 func = getattr(agent, method, None)
                 if not func:
                     raise DistributedAgentException('No such method {} in agent {}.'.format(method, agent))
                 
+                if DistributedAgent._channels.unreachable(node, self.port):
+                    # No point waiting on a call that will fail. 
+                    add(node, None, 'unreachable')
+                    continue
+
                 log.debug('On node {}, calling: {}(...)'.format(node, method))
-                calls[tpe.submit(func, args)] = node
+                calls[tpe.submit(self._call_node, node, key, func, per_node_args(args, per_node, node), deadline,
+                                 retry, hedge, inflight)] = node
 
-            for f in futures.as_completed(calls):
-                try: 
+            try:
+                # Each RPC has its own deadline, this is just a backstop.
+                for f in futures.as_completed(calls, timeout=None if not timeout else timeout + 1):
                     node = calls[f]
-                    r = f.result()
-                except grpc.RpcError as e:
-                    # I'm not sure when this gets raised when using a thread pool executor...
-                    log.critical('RPC error: {}'.format(e))
-                    raise DistributedAgentException(e)
+                    try: 
+                        add(node, f.result())
+                    except grpc.RpcError as e:
+                        log.error('RPC error on {}: {}'.format(node, e))
+                        add(node, None, e.details(), e.code() == grpc.StatusCode.DEADLINE_EXCEEDED)
+                    except _DeadlineExceeded:
+                        add(node, None, 'timed out waiting to be called', True)
 
-                comment = '' if not r.comment else ': {}'.format(r.comment)
-                log.debug('{}: {}() --> {}{}'.format(node.split('.')[0], method, r.success, comment))
-                responses.add(node, r)
+                    # Out of all nodes, as success() counts them, including the unreachable ones.
+                    if responses.decided(len(self.agents)):
+                        break
+            except futures.TimeoutError:
+                pass
+
+            # don't bother starting calls that have not gone out yet, and end those that have.
+            for f in calls:
+                f.cancel()
+            inflight.cancel()
+
+        # Anything left either did not answer in time or was not waited for.
+        for node in self.agents:
+            if not node in responses:
+                if deadline and time.monotonic() >= deadline:
+                    responses.add_error(node, 'timed out', True)
+                else:
+                    responses.unfinished.append(node)
 
         return responses
 
-    def blocking_call_server_streaming(self, method, args):
-        '''Much like blocking_call, but yields responses when they happen. Should only be invoked on 
-        agent methods that return a stream of things.
+    def _call_node(self, node, key, func, args, deadline, retry=None, hedge=None, inflight=None):
+        '''Make a single call, within what is left of the deadline of the whole fan-out, and 
+        record how long it took under key. retry is a RetryPolicy and hedge, if given, is the
+        (delay, max_hedges, _HedgeBudget) to hedge with. If inflight is given, the call is made
+        as a grpc future added to it, so that it can be cancelled.'''
+        if deadline is not None and deadline <= time.monotonic():
+            raise _DeadlineExceeded()
+
+        attempt = 1
+        while True:
+            error = True
+            cancelled = False
+            start = time.monotonic()
+            try:
+                kwargs = {} if deadline is None else {'timeout': max(0, deadline - start)}
+                if hedge:
+                    r = self._hedged_call(func, args, deadline, *hedge, inflight=inflight)
+                elif inflight:
+                    r = inflight.result(func.future(args, **kwargs))
+                else:
+                    r = func(args, **kwargs)
+
+                error = False
+                return r
+            except grpc.FutureCancelledError:
+                # Not waited for, so how long it took means nothing.
+                cancelled = True
+                raise
+            except grpc.RpcError as e:
+                if not retry or not retry.retryable(e, attempt):
+                    raise
+
+                wait = retry.backoff(attempt)
+                if deadline is not None and time.monotonic() + wait >= deadline:
+                    raise
+
+                log.debug('{}: {} failed ({}), retrying in {:.3f}s'.format(node, key, e.code(), wait))
+            finally:
+                if not cancelled:
+                    self.latency.record(node, key, time.monotonic() - start, error)
+
+            if inflight:
+                if inflight.cancelled.wait(wait):
+                    raise grpc.FutureCancelledError()
+            else:
+                time.sleep(wait)
+            attempt += 1
+
+    @staticmethod
+    def _hedged_call(func, args, deadline, delay, max_hedges, budget, inflight=None):
+        '''Call func with args. Each time delay seconds pass without an answer, send the request
+        again, up to max_hedges times and while the budget allows. Returns the first successful
+        response, or raises the last error if all of the requests failed. The requests are added
+        to inflight, if given.'''
+        done = Queue()
+        calls = []
+
+        def send():
+            kwargs = {} if deadline is None else {'timeout': max(0, deadline - time.monotonic())}
+            f = func.future(args, **kwargs)
+            f.add_done_callback(done.put)
+            calls.append(f)
+            if inflight:
+                inflight.add(f)
+
+        send()
+        outstanding = 1
+        hedging = True
+        error = None
+        try:
+            while outstanding:
+                try:
+                    f = done.get(timeout=delay if hedging else None)
+                except Empty:
+                    if budget.take():
+                        send()
+                        outstanding += 1
+                        hedging = len(calls) <= max_hedges
+                    else:
+                        hedging = False
+                    continue
+
+                outstanding -= 1
+                error = f.exception()
+                if error is None:
+                    return f.result()
+
+            raise error
+        finally:
+            for f in calls:
+                f.cancel()
+
+    @staticmethod
+    def _completion_args(completion, count):
+        if completion == Completion.ALL:
+            return {}
+        elif completion == Completion.BEST_EFFORT:
+            return {'tolerate_timeouts': True}
+        elif completion == Completion.QUORUM:
+            return {'quorum': True}
+        elif completion == Completion.FIRST:
+            return {'required': count if count else 1}
+
+        raise DistributedAgentException('Unknown completion {}'.format(completion))
+
+    def _method_info(self, method, args=None):
+        '''Return the grpc method path and response class for the given method of this agent.'''
+        service = self.service
+        if not service and args is not None:
+            service = args.DESCRIPTOR.file.services_by_name.get(self._agent_name)
+
+        if not service or not method in service.methods_by_name:
+            raise DistributedAgentException('No such method {} in agent {}.'.format(method, self._agent_name))
 
-        Note that the implementation is still sequential, so the order of return will be the order
-        of agents. Calls do not happen in parallel (yet). 
+        return '/{}/{}'.format(service.full_name, method), GetMessageClass(service.methods_by_name[method].output_type)
+
+    def _relay_call(self, path, args, response_class, nodes, timeout=None, per_node=None):
+        '''Call the method at path on all nodes by relaying through a tree of daemons. Only
+        the heads of the tree are called directly. Yields (node, response, error, timed_out) 
+        as each head's subtree answers. response is None if there was an error.'''
+        calls = {}
+        tpe = self._get_executor()
+        key = method_key(path)
+        request = args.SerializeToString()
+        node_requests = {}
+        if per_node is not None:
+            for n in nodes:
+                node_args = per_node_args(args, per_node, n)
+                if node_args is not args:
+                    node_requests[n] = node_args.SerializeToString()
+
+        for head, subtree in relay_tree(nodes, self.relay_fanout):
+            log.debug('Relaying {} via {} to {} nodes'.format(path, head, len(subtree)))
+            relay_args = pb.RelayArgs(method=path, request=request, node=head, subtree=subtree,
+                                      fanout=self.relay_fanout, port=self.port, timeout=timeout,
+                                      node_requests={n: node_requests[n] for n in [head] + subtree if n in node_requests})
+            calls[tpe.submit(self._server_agent(head).Relay, relay_args, timeout=timeout)] = (head, subtree)
+
+        try:
+            for f in futures.as_completed(calls, timeout=None if not timeout else timeout + 1):
+                head, subtree = calls[f]
+                try:
+                    relayed = f.result()
+                except grpc.RpcError as e:
+                    log.error('RPC error relaying via {}: {}'.format(head, e))
+                    timed_out = e.code() == grpc.StatusCode.DEADLINE_EXCEEDED
+                    for n in [head] + subtree:
+                        yield n, None, 'RPC error via {}: {}'.format(head, e.details()), timed_out
+
+                    continue
+
+                for nr in relayed.responses:
+                    if not nr.ok:
+                        yield nr.node, None, nr.comment, nr.timed_out
+                    else:
+                        self.latency.record(nr.node, key, nr.latency)
+                        yield nr.node, response_class.FromString(nr.response), None, False
+        except futures.TimeoutError:
+            pass
+
+    def blocking_call_server_streaming(self, method, args, timeout=None, per_node=None, retry=None):
+        '''Much like blocking_call, but yields (node, response) when they happen. Should only be invoked on 
+        agent methods that return a stream of things. If timeout is given, the streams are
+        ended after that many seconds. per_node and retry work as in blocking_call().
+
+        Each node has its own buffer of at most stream_buffer messages. A node is not read from
+        while its buffer is full, so memory use does not grow with a slow caller and a chatty node
+        cannot crowd out the others. Leaving the loop early (or closing the generator) cancels
+        all the streams.
         '''
+        retry, _ = self._call_policy(method, retry, None)
+        deadline = None if not timeout else time.monotonic() + timeout
+
+        def call(node):
+            func = getattr(self.agents[node], method, None)
+            if not func:
+                raise DistributedAgentException('No such method {} in agent {}.'.format(method, self.agents[node]))
+
+            log.debug('On node {}, calling: {}(...)'.format(node, method))
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            return func(per_node_args(args, per_node, node), timeout=remaining)
+
+        # For each agent start the call, then merge the streams.
+        streams = {node: call(node) for node in self.agents}
+        yield from self._merge_streams(streams, '{}.{}'.format(self._agent_name, method), 
+                                       call if retry else None, retry)
+
+    def _merge_streams(self, streams, key=None, restart=None, retry=None, yield_errors=False):
+        '''Yield (node, response) from the given dict of node to response stream as they arrive.
+        If key is given, the time to each node's first message is recorded under it. If restart
+        is given, a stream that fails before its first message is restarted with restart(node), 
+        as the RetryPolicy retry allows. A stream that fails raises DistributedAgentException and
+        cancels the others, unless yield_errors, in which case (node, grpc.RpcError) is yielded
+        and the other streams carry on.'''
+        start = time.monotonic()
+        stopped = Event()
+        buffers = {}
+        # Nodes with a message waiting in their buffer, once per message, in arrival order.
+        ready = Queue()
         produce_threads = []
-        q = Queue()
 
         # local function that will be threaded to read responses. 
-        def read_responses(func, args, node):
+        def read_responses(node, stream):
             log.debug('Read reponses thread created.')
-            log.debug('On node {}, calling: {}(...)'.format(node, method))
+            first = True
+            attempt = 1
             try:
-                for r in func(args):
-                    log.debug('stream response: {} ({})'.format(r, type(r)))
-                    q.put((node, r))
-            except grpc.RpcError as e:
-                log.critical('RPC error: {}'.format(e))
-                raise DistributedAgentException(e)
+                while True:
+                    try:
+                        for r in stream:
+                            if first and key:
+                                self.latency.record(node, key, time.monotonic() - start)
+                            first = False
 
-            q.put((None, None))
+                            buffers[node].put(r)
+                            ready.put(node)
+                        break
+                    except grpc.RpcError as e:
+                        if first and key and e.code() != grpc.StatusCode.CANCELLED:
+                            self.latency.record(node, key, time.monotonic() - start, True)
 
-        # For each agent create a producer thread that feeds the queue
-        for node, agent in self.agents.items():
-            func = getattr(agent, method, None)
-            if not func:
-                raise DistributedAgentException('No such method {} in agent {}.'.format(method, agent))
+                        if first and restart and retry.retryable(e, attempt) and not stopped.is_set():
+                            wait = retry.backoff(attempt)
+                            log.debug('{}: stream failed ({}), retrying in {:.3f}s'.format(node, e.code(), wait))
+                            if not stopped.wait(wait):
+                                attempt += 1
+                                stream = streams[node] = restart(node)
+                                # the caller may have gone away while the stream was restarted.
+                                if stopped.is_set():
+                                    stream.cancel()
 
-            t = Thread(target=read_responses, args=(func, args, node, ))
+                                continue
+
+                        buffers[node].put(e)
+                        ready.put(node)
+                        break
+            finally:
+                buffers[node].put(_END_OF_STREAM)
+                ready.put(node)
+
+        # create a producer thread per node that feeds its buffer.
+        for node, stream in streams.items():
+            buffers[node] = Queue(maxsize=self.stream_buffer)
+            t = Thread(target=read_responses, args=(node, stream), daemon=True)
             produce_threads.append(t)
             t.start()
-       
-        # Now read the queue until we see all producers are done.
+
+        # Now read the buffers until we see all producers are done.
         done_count = 0
-        while done_count != len(produce_threads):
-            node, r = q.get()
-            if r == None:
-                done_count += 1
+        try:
+            while done_count != len(produce_threads):
+                node = ready.get()
+                r = buffers[node].get()
+                if r is _END_OF_STREAM:
+                    done_count += 1
+                elif isinstance(r, grpc.RpcError):
+                    if yield_errors:
+                        yield node, r
+                    elif not r.code() in [grpc.StatusCode.CANCELLED, grpc.StatusCode.DEADLINE_EXCEEDED]:
+                        log.critical('RPC error: {}'.format(r))
+                        raise DistributedAgentException(r)
+                else:
+                    log.debug('{}: --> {}'.format(node.split('.')[0], r))
+                    yield node, r
+        finally:
+            stopped.set()
+            if done_count != len(produce_threads):
+                log.debug('Cancelling {} streams.'.format(len(streams)))
+                for stream in streams.values():
+                    stream.cancel()
+
+                # Unblock producers waiting on a full buffer so they see the cancellation and exit.
+                for b in buffers.values():
+                    while not b.empty():
+                        b.get_nowait()
+
+    def run_plan(self, plan, timeout=None):
+        '''Run the steps of the given DistributedAgentPlan on all of this agent's nodes. Each node's
+        agent server runs the steps itself, in order and with their delays, so there is no round
+        trip to the controller between steps. Returns a list of DistributedAgentResponses, one per
+        step. A node that stopped before a step (because an earlier step failed) is listed in that
+        step's responses.unfinished. A node whose RunPlan call fails has the error recorded
+        against the step it was on; the other nodes run the plan to the end regardless.'''
+        plan_args = plan.plan_args()
+        streams = {}
+        for node in self.agents:
+            log.debug('On node {}, running a {} step plan.'.format(node, len(plan_args.steps)))
+            streams[node] = self._server_agent(node).RunPlan(plan_args, timeout=timeout)
+
+        results = [DistributedAgentResponses() for _ in plan_args.steps]
+        # The step each node is on.
+        steps = {node: 0 for node in streams}
+        for node, r in self._merge_streams(streams, yield_errors=True):
+            if isinstance(r, grpc.RpcError):
+                log.error('RunPlan on {} failed at step {}: {}'.format(node, steps[node], r.details()))
+                if steps[node] < len(results):
+                    results[steps[node]].add_error(node, r.details(), r.code() == grpc.StatusCode.DEADLINE_EXCEEDED)
+                continue
+
+            steps[node] = r.step + 1
+            if not r.ok:
+                results[r.step].add_error(node, r.comment, r.timed_out)
             else:
-                comment = '' if not r.comment else ': {}'.format(r.comment)
-                log.debug('{}: --> {}'.format(node.split('.')[0], r))
-                yield node, r
+                results[r.step].add(node, plan.response_class(r.step).FromString(r.response))
+
+        for responses in results:
+            for node in self.agents:
+                if not node in responses:
+                    responses.unfinished.append(node)
 
-            q.task_done()
+        return results
 
-        for t in produce_threads:
-            t.join()
+class DistributedAgentPlan:
+    '''An ordered list of agent method calls that the agent server on each node runs itself. See
+    DistributedAgent.run_plan(). For example, a whole tcpdump collection with one round trip:
+
+        plan = DistributedAgentPlan()
+        plan.add(tcpdump, 'Configure', dumpfile='/tmp/tcpdump.cap')
+        plan.add(tcpdump, 'StartCollection', destination='traf21')
+        plan.add(tcpdump, 'StopCollection', delay=60)
+        plan.add(tcpdump, 'ArchiveDump', path='/zfs/edgelab/glawler/tcpdumps', tag='GTL')
+        results = tcpdump.run_plan(plan)
+
+    Steps may call methods of any agent loaded on the nodes the plan is run on.
+    '''
+    def __init__(self, continue_on_failure=False):
+        # If False, a node stops running the plan at the first step that fails.
+        self.continue_on_failure = continue_on_failure
+        self._steps = []
+        self._response_classes = []
+
+    def __len__(self):
+        return len(self._steps)
+
+    def add(self, agent, method, **kwargs):
+        '''Add a call to agent's method to the plan. kwargs are the method's arguments, as for the
+        agent's method itself, and:
+            delay, the seconds to wait after the previous step finishes before starting this one.
+            timeout, the deadline of the step's call.
+        If the method's message has a field named delay or timeout, that name is the field and
+        the step's is given as _delay or _timeout, as with the agent's own call options.'''
+        path, response_class = agent._method_info(method)
+        args_class = GetMessageClass(agent.service.methods_by_name[method].input_type)
+        fields = args_class.DESCRIPTOR.fields_by_name
+        delay = kwargs.pop('_delay' if 'delay' in fields else 'delay', 0)
+        timeout = kwargs.pop('_timeout' if 'timeout' in fields else 'timeout', None)
+        self._steps.append(pb.Plan.Step(method=path, request=args_class(**kwargs).SerializeToString(),
+                                        delay=delay, timeout=timeout))
+        self._response_classes.append(response_class)
+        return self
+
+    def response_class(self, step):
+        return self._response_classes[step]
+
+    def plan_args(self):
+        return pb.Plan(steps=self._steps, continue_on_failure=self.continue_on_failure)
+
+class AsyncDistributedAgent:
+    '''The asyncio version of DistributedAgent. Calls to all nodes are made over grpc.aio channels
+    and run concurrently on the caller's event loop, so there is no thread per node or per call. 
+    Agents must be loaded and used from within a running event loop:
+
+        tcpdump = await AsyncTcpdumpAgent(nodes).load()
+        responses = await tcpdump.Configure(dumpfile='/tmp/tcpdump.cap')
+        async for node, status in tcpdump.Status():
+            ...
+        await tcpdump.close()
+
+    aio channels are bound to the event loop they were created on, so all async agents in a 
+    process should share one loop.
+    '''
+    # Shared by all async agents, as in DistributedAgent.
+    _channels = AsyncDistributedAgentChannels()
+    stream_buffer = DistributedAgent.stream_buffer
+    service = None
+
+    def __init__(self, nodes, port):
+        self.port = port
+        self.nodes = nodes
+
+        # agents created by users
+        self.agents = {}
+        # nodes we hold a channel reference to.
+        self._acquired = set()
+
+    async def load_agent(self, name, agent_stub):
+        '''Async version of DistributedAgent.load_agent().'''
+        log.info('Loading {}'.format(name))
+        channels = AsyncDistributedAgent._channels
+        load_nodes = []
+        for n in self.nodes:
+            if not n in self._acquired:
+                channels.acquire(n, self.port)
+                self._acquired.add(n)
+
+            if not channels.loaded(n, self.port, name):
+                load_nodes.append(n)
+
+        try:
+            results = await asyncio.gather(
+                *[channels.server_agent(n, self.port).Load(pb.AgentConfig(name=name)) for n in load_nodes],
+                return_exceptions=True)
+
+            for n, response in zip(load_nodes, results):
+                if isinstance(response, Exception):
+                    msg = 'Error: {}'.format(response)
+                    log.critical(msg)
+                    raise DistributedAgentException(msg)
+
+                if not response.success:
+                    raise DistributedAgentException(
+                        'Error loading {} on node {}: {}'.format(name, n, response.comment))
+
+                channels.set_loaded(n, self.port, name)
+        except BaseException:
+            # As in the sync version, let go of the channels rather than leak a reference to each.
+            await self.close()
+            raise
+
+        try:
+            for n in self.nodes:
+                self.agents[n] = agent_stub(channels.channel(n, self.port))
+        except Exception as e:
+            msg = 'Error creating agent client stub: {}'.format(e)
+            log.critical(msg)
+            raise DistributedAgentException(msg)
+
+        log.info('Loaded {} (server-side) on {}'.format(name, ', '.join(self.nodes)))
+
+    async def close(self):
+        '''Cleanup and close any existing agents. Channels are closed once no other async agent
+        is using them.'''
+        self.agents = {}
+        acquired, self._acquired = self._acquired, set()
+        await asyncio.gather(*[AsyncDistributedAgent._channels.release(n, self.port) for n in acquired])
+
+    def _method(self, agent, method):
+        func = getattr(agent, method, None)
+        if not func:
+            raise DistributedAgentException('No such method {} in agent {}.'.format(method, agent))
+
+        return func
+
+    async def call(self, method, args, timeout=None, completion=None, count=None, per_node=None):
+        '''Call the given method with the given args on all nodes concurrently and return the 
+        responses. timeout, completion and per_node work as in DistributedAgent.blocking_call().'''
+        completion = Completion.ALL if completion is None else completion
+        responses = DistributedAgentResponses(**DistributedAgent._completion_args(completion, count))
+        deadline = None if not timeout else time.monotonic() + timeout
+        key = '{}.{}'.format(self.service.name if self.service else '', method)
+        start = time.monotonic()
+        tasks = {}
+        for node, agent in self.agents.items():
+            log.debug('On node {}, calling: {}(...)'.format(node, method))
+            node_args = per_node_args(args, per_node, node)
+            t = asyncio.ensure_future(self._method(agent, method)(node_args, timeout=timeout))
+            t.add_done_callback(lambda t, node=node: t.cancelled() or DistributedAgent.latency.record(
+                node, key, time.monotonic() - start, t.exception() is not None))
+            tasks[t] = node
+
+        pending = set(tasks)
+        try:
+            while pending:
+                # Each RPC has its own deadline, the wait timeout is just a backstop.
+                done, pending = await asyncio.wait(pending, timeout=None if not timeout else timeout + 1, 
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+
+                for t in done:
+                    node = tasks[t]
+                    try:
+                        r = t.result()
+                    except grpc.RpcError as e:
+                        log.error('RPC error on {}: {}'.format(node, e))
+                        responses.add_error(node, e.details(), e.code() == grpc.StatusCode.DEADLINE_EXCEEDED)
+                        continue
+
+                    comment = '' if not r.comment else ': {}'.format(r.comment)
+                    log.debug('{}: {}() --> {}{}'.format(node.split('.')[0], method, r.success, comment))
+                    responses.add(node, r)
+
+                if responses.decided(len(tasks)):
+                    break
+        finally:
+            for t in pending:
+                t.cancel()
+
+        for node in self.agents:
+            if not node in responses:
+                if deadline and time.monotonic() >= deadline:
+                    responses.add_error(node, 'timed out', True)
+                else:
+                    responses.unfinished.append(node)
+
+        return responses
+
+    async def call_server_streaming(self, method, args, timeout=None, per_node=None, yield_errors=False):
+        '''Async generator that yields (node, response) from all nodes as they arrive. Should only 
+        be invoked on agent methods that return a stream of things. Leaving the loop early cancels
+        all the streams. If timeout is given, the streams are ended after that many seconds.
+        As in the sync version, each node buffers at most stream_buffer messages, and a stream
+        that fails raises DistributedAgentException unless yield_errors, in which case
+        (node, grpc.RpcError) is yielded and the other streams carry on.'''
+        calls = {}
+        buffers = {}
+        ready = asyncio.Queue()
+        for node, agent in self.agents.items():
+            log.debug('On node {}, calling: {}(...)'.format(node, method))
+            calls[node] = self._method(agent, method)(per_node_args(args, per_node, node), timeout=timeout)
+            buffers[node] = asyncio.Queue(maxsize=self.stream_buffer)
+
+        async def read_responses(node, call):
+            try:
+                async for r in call:
+                    await buffers[node].put(r)
+                    ready.put_nowait(node)
+            except grpc.RpcError as e:
+                await buffers[node].put(e)
+                ready.put_nowait(node)
+
+            await buffers[node].put(_END_OF_STREAM)
+            ready.put_nowait(node)
+
+        tasks = [asyncio.ensure_future(read_responses(n, c)) for n, c in calls.items()]
+        done_count = 0
+        try:
+            while done_count != len(tasks):
+                node = await ready.get()
+                r = buffers[node].get_nowait()
+                if r is _END_OF_STREAM:
+                    done_count += 1
+                elif isinstance(r, grpc.RpcError):
+                    if yield_errors:
+                        yield node, r
+                    elif not r.code() in [grpc.StatusCode.CANCELLED, grpc.StatusCode.DEADLINE_EXCEEDED]:
+                        log.critical('RPC error: {}'.format(r))
+                        raise DistributedAgentException(r)
+                else:
+                    log.debug('{}: --> {}'.format(node.split('.')[0], r))
+                    yield node, r
+        finally:
+            for c in calls.values():
+                c.cancel()
+
+            for t in tasks:
+                t.cancel()
 
 '''Aux class that exists simply as a shim between protobuffer classes and python. It will mirror exactly
-the protobuf Response data.'''
+the protobuf Response data. If the node could not be called, success is False, error and comment 
+say why and timed_out is True if the node did not answer in time.'''
 class DistributedAgentResponse(): 
-    def __init__(self, pbresp):
+    __slots__ = ('success', 'comment', 'error', 'timed_out')
+
+    def __init__(self, pbresp=None, error=None, timed_out=False):
         # GTL TODO - figure out a smart way to copy instance variables without naming them speciffically.
-        self.success = pbresp.success
-        self.comment = pbresp.comment
+        if pbresp is not None:
+            self.success = pbresp.success
+            self.comment = pbresp.comment
+        else:
+            self.success = False
+            self.comment = error
+
+        self.error = error
+        self.timed_out = timed_out
 
-'''This is a dict of responses indexed by host with a few util methods added.'''
+'''Responses indexed by host with a few util methods added. Responses are kept in columns rather 
+than as an object per host: a list of hosts, and arrays of success/timeout/error flags and comment 
+ids, with each distinct comment stored once. Counts are kept as responses are added, so success() 
+does not walk the responses and queries like failed() run over the arrays.'''
 class DistributedAgentResponses:
-    def __init__(self):
-        self._responses = {}
+    def __init__(self, required=None, quorum=False, tolerate_timeouts=False):
+        self._hosts = []
+        self._index = {}
+        self._success = array('b')
+        self._failed = array('b')
+        self._timed_out = array('b')
+        self._errored = array('b')
+        self._comment_ids = array('l')
+        self._comments = []
+        self._comment_index = {}
+        # Responses with more in them than success and comment, by host.
+        self._messages = {}
+        self._n_success = 0
+        self._n_timed_out = 0
+
+        # How many nodes must succeed for success(). None means all of them.
+        self._required = required
+        self._quorum = quorum
+        self._tolerate_timeouts = tolerate_timeouts
+        # Nodes that had not answered when the call returned, but did not time out either.
+        self.unfinished = []
+
+    def __contains__(self, host):
+        return host in self._index
+
+    def __len__(self):
+        return len(self._hosts)
+
+    def __iter__(self):
+        return iter(self._hosts)
+
+    def __getitem__(self, host):
+        return self._row(self._index[host])
+
+    def items(self):
+        for i, host in enumerate(self._hosts):
+            yield host, self._row(i)
+
+    def _row(self, i):
+        r = DistributedAgentResponse.__new__(DistributedAgentResponse)
+        r.success = bool(self._success[i])
+        r.comment = self._comments[self._comment_ids[i]]
+        r.error = r.comment if self._errored[i] else None
+        r.timed_out = bool(self._timed_out[i])
+        return r
+
+    def _comment_id(self, comment):
+        cid = self._comment_index.get(comment)
+        if cid is None:
+            cid = len(self._comments)
+            self._comments.append(comment)
+            self._comment_index[comment] = cid
+
+        return cid
+
+    def _set(self, host, success, comment, errored, timed_out):
+        i = self._index.get(host)
+        if i is None:
+            i = len(self._hosts)
+            self._index[host] = i
+            self._hosts.append(host)
+            for column in [self._success, self._failed, self._timed_out, self._errored, self._comment_ids]:
+                column.append(0)
+        else:
+            self._n_success -= self._success[i]
+            self._n_timed_out -= self._timed_out[i]
+            self._messages.pop(host, None)
+
+        self._success[i] = success
+        self._failed[i] = not success
+        self._timed_out[i] = timed_out
+        self._errored[i] = errored
+        self._comment_ids[i] = self._comment_id(comment)
+        self._n_success += success
+        self._n_timed_out += timed_out
 
     def add(self, host, resp):
         '''Add this response from this host. Will overwrite host's entry if it exists.'''
-        self._responses[host] = DistributedAgentResponse(resp)
+        self._set(host, bool(resp.success), resp.comment, False, False)
+        if len(resp.DESCRIPTOR.fields) > 2:
+            self._messages[host] = resp
+
+    def add_error(self, host, error, timed_out=False):
+        '''Record that host could not be called or did not answer in time.'''
+        self._set(host, False, error if error else '', True, bool(timed_out))
+
+    def message(self, host):
+        '''Return the full response message from host, or None if it only held success and comment.'''
+        return self._messages.get(host)
+
+    def succeeded(self):
+        return list(compress(self._hosts, self._success))
+
+    def failed(self):
+        '''Nodes that answered with success=False, errored or timed out.'''
+        return list(compress(self._hosts, self._failed))
+
+    def timed_out(self):
+        return list(compress(self._hosts, self._timed_out))
+
+    def errored(self):
+        '''Nodes that could not be called or did not answer.'''
+        return list(compress(self._hosts, self._errored))
+
+    def success_ratio(self):
+        return self._n_success / len(self._hosts) if self._hosts else 0.0
+
+    def by_comment(self, failed_only=False):
+        '''Return a dict of comment to the list of hosts that responded with it.'''
+        groups = {}
+        rows = compress(range(len(self._hosts)), self._failed) if failed_only else range(len(self._hosts))
+        for i in rows:
+            groups.setdefault(self._comment_ids[i], []).append(self._hosts[i])
+
+        return {self._comments[cid]: hosts for cid, hosts in groups.items()}
+
+    def _needed(self, total):
+        if self._quorum:
+            return total // 2 + 1
+
+        return self._required
+
+    def decided(self, total):
+        '''True if enough of the total nodes have answered to know what success() will be.'''
+        needed = self._needed(total)
+        if needed is None:
+            return False
+
+        return self._n_success >= needed or len(self._hosts) - self._n_success > total - needed
 
     def success(self):
-        for k, v in self._responses.items():
-            if not v.success:
-                return False
+        needed = self._needed(len(self._hosts) + len(self.unfinished))
+        if needed is not None:
+            return self._n_success >= needed
 
-        return True
+        not_successful = len(self._hosts) - self._n_success + len(self.unfinished)
+        if self._tolerate_timeouts:
+            not_successful -= self._n_timed_out
+
+        return not_successful == 0
 
     def status(self):
         '''Return string suitable for logging/printing based on responses.'''
+        failed = ['{}={}'.format(self._hosts[i], 'timeout' if self._timed_out[i] else False) 
+                  for i in compress(range(len(self._hosts)), self._failed)]
+        failed += ['{}=unfinished'.format(n) for n in self.unfinished]
         if self.success():
-            return "SUCCESS: All nodes."
+            if not failed:
+                return "SUCCESS: All nodes."
+
+            return 'SUCCESS: {} of {} nodes. Not successful: {}'.format(
+                self._n_success, len(self._hosts) + len(self.unfinished), ', '.join(failed))
 
-        failed = ['{}={}'.format(node, vs.success) for node, vs in self._responses.items() if not vs.success]
         return 'FAILED: {}'.format(', '.join(failed))
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+
+'''
+Measure how DistributedAgent behaves as the number of nodes grows, without a testbed.
+
+A farm of fake agent servers is started in a child process. Each fake node is its own loopback
+address (127.x.y.z) on the same port, so the client sees N distinct nodes just as it would on a
+testbed. The fake nodes answer AgentServer.Load and implement the IperfAgent service with an
+injected latency (and optional stragglers and failures). The client then times load_agent(),
+blocking_call(), blocking_call_server_streaming() and run_plan() for each node count given, and
+reports latency percentiles, throughput and the client's memory use. For the streams, these are the
+percentiles of the time to each node's first message and of the time between its messages.
+
+With --down, that many nodes stop answering once the agent is loaded, as nodes that die part way
+through an experiment do. Calls and plans must still collect the other nodes' answers; if they do
+not, the run says so and exits non-zero. The async agent's streams are checked against the down
+nodes too. With --relay-fanout, the fake nodes relay calls to each
+other as agent servers do, so a node that is down loses its subtree.
+
+    ./fanout_benchmark.py --nodes 1,10,100,1000 --latency 0.005 --failure-rate 0.01
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import resource
+import time
+from concurrent import futures
+from multiprocessing import get_context
+from threading import Lock
+
+import grpc
+
+from dgrpc import agent_server_pb2 as pb
+from dgrpc import agent_server_pb2_grpc as pb_grpc
+from dgrpc import iperf_agent_pb2 as iperf_pb
+from dgrpc import iperf_agent_pb2_grpc as iperf_pb_grpc
+from dgrpc.distributed_agent import (Completion, DistributedAgent, DistributedAgentException, DistributedAgentPlan,
+                                     LatencyHistogram, relay_tree)
+from dgrpc.iperf_agent import AsyncIperfAgent, IperfAgent
+
+log = logging.getLogger(__name__)
+
+# What the fake IperfAgent methods answer, serialized.
+_OK = iperf_pb.Response(success=True, comment='').SerializeToString()
+
+class FakeAgentServerServicer(pb_grpc.AgentServerServicer):
+    '''Loads nothing, but says it did. Plan steps and relayed calls take the injected latency and
+    answer as IperfAgent methods do. Relays go on to the rest of the subtree as the agent server's
+    do, so a node that is down loses its subtree.'''
+    def __init__(self, iperf, threads):
+        self._iperf = iperf
+        self._relay_pool = futures.ThreadPoolExecutor(max_workers=threads)
+        self._relay_lock = Lock()
+        self._relay_stubs = {}
+
+    def Load(self, request, context):
+        return pb.Response(success=True, comment='{} loaded.'.format(request.name))
+
+    def Relay(self, request, context):
+        timeout = request.timeout * 0.9 if request.timeout else None
+        calls = {}
+        for child, subtree in relay_tree(request.subtree, request.fanout):
+            args = pb.RelayArgs(method=request.method, request=request.request, node=child, subtree=subtree,
+                                fanout=request.fanout, port=request.port, timeout=timeout,
+                                node_requests={n: request.node_requests[n] for n in [child] + subtree
+                                               if n in request.node_requests})
+            stub = self._relay_stub('{}:{}'.format(child, request.port))
+            calls[self._relay_pool.submit(stub.Relay, args, timeout=timeout)] = (child, subtree)
+
+        relayed = pb.RelayResponse()
+        start = time.monotonic()
+        # Loading always works, as with Load().
+        if not request.method.endswith('/Load') and self._iperf.delay():
+            relayed.responses.add(node=request.node, ok=False, comment='injected failure')
+        else:
+            relayed.responses.add(node=request.node, ok=True, response=_OK, latency=time.monotonic() - start)
+
+        for f in futures.as_completed(calls):
+            child, subtree = calls[f]
+            try:
+                relayed.responses.extend(f.result().responses)
+            except grpc.RpcError as e:
+                for n in [child] + subtree:
+                    relayed.responses.add(node=n, ok=False, comment='RPC error via {}: {}'.format(child, e.details()),
+                                          timed_out=e.code() == grpc.StatusCode.DEADLINE_EXCEEDED)
+
+        return relayed
+
+    def _relay_stub(self, target):
+        with self._relay_lock:
+            if not target in self._relay_stubs:
+                self._relay_stubs[target] = pb_grpc.AgentServerStub(grpc.insecure_channel(target))
+
+            return self._relay_stubs[target]
+
+    def RunPlan(self, request, context):
+        for i, step in enumerate(request.steps):
+            time.sleep(step.delay)
+            if self._iperf.delay():
+                yield pb.StepResult(step=i, ok=False, comment='injected failure')
+                if not request.continue_on_failure:
+                    return
+            else:
+                yield pb.StepResult(step=i, ok=True, response=_OK)
+
+class FakeIperfAgentServicer(iperf_pb_grpc.IperfAgentServicer):
+    '''Answers IperfAgent calls after an injected delay. Some calls are made stragglers and some fail.'''
+    def __init__(self, latency, jitter, straggler_rate, straggler_latency, failure_rate):
+        self.latency = latency
+        self.jitter = jitter
+        self.straggler_rate = straggler_rate
+        self.straggler_latency = straggler_latency
+        self.failure_rate = failure_rate
+
+    def delay(self):
+        '''Wait as long as a call takes. Returns True if the call is to fail.'''
+        delay = max(0, random.gauss(self.latency, self.jitter))
+        if random.random() < self.straggler_rate:
+            delay += self.straggler_latency
+
+        time.sleep(delay)
+        return random.random() < self.failure_rate
+
+    def _delay(self, context):
+        if self.delay():
+            context.abort(grpc.StatusCode.UNAVAILABLE, 'injected failure')
+
+    def Configure(self, request, context):
+        self._delay(context)
+        return iperf_pb.Response(success=True, comment='')
+
+    def StartTraffic(self, request, context):
+        self._delay(context)
+        return iperf_pb.Response(success=True, comment='')
+
+    def StopTraffic(self, request, context):
+        self._delay(context)
+        return iperf_pb.Response(success=True, comment='')
+
+    def Status(self, request, context):
+        for i in range(request.count if request.count else 1):
+            self._delay(context)
+            yield iperf_pb.StatusResponse(success=True, comment='', retries=i)
+
+def fake_nodes(count):
+    '''Return count distinct loopback addresses, skipping network and broadcast looking ones.'''
+    nodes = []
+    i = 0
+    while len(nodes) < count:
+        i += 1
+        a, b, c = (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff
+        if c in [0, 255]:
+            continue
+
+        nodes.append('127.{}.{}.{}'.format(a, b, c))
+
+    return nodes
+
+def run_farm(nodes, port, servers, threads, servicer_args, ready, stop, down=(), kill=None, killed=None):
+    '''Serve the fake agent servers on all nodes until stop is set. The nodes are spread over
+    servers grpc servers with threads worker threads each. The down nodes have a server of their
+    own, which is stopped once kill is set, setting killed when it has.'''
+    raise_fd_limit()
+    # The same options agent_server uses, so client keepalives are accepted.
+    options = [
+        ('grpc.keepalive_permit_without_calls', 1),
+        ('grpc.http2.min_ping_interval_without_data_ms', 10000),
+        ('grpc.http2.max_pings_without_data', 0),
+    ]
+    def start(nodes):
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=threads), options=options)
+        iperf = FakeIperfAgentServicer(*servicer_args)
+        pb_grpc.add_AgentServerServicer_to_server(FakeAgentServerServicer(iperf, threads), server)
+        iperf_pb_grpc.add_IperfAgentServicer_to_server(iperf, server)
+        for node in nodes:
+            server.add_insecure_port('{}:{}'.format(node, port))
+
+        server.start()
+        return server
+
+    up = [n for n in nodes if not n in down]
+    farm = [start(up[i::servers]) for i in range(servers)]
+    doomed = start(down) if down else None
+    ready.set()
+    if doomed:
+        kill.wait()
+        doomed.stop(0).wait()
+        killed.set()
+
+    stop.wait()
+    for server in farm:
+        server.stop(0)
+
+def reached(nodes, down, fanout):
+    '''The nodes a call reaches when the down nodes do not answer. When relayed with fanout, a down
+    node takes the rest of its subtree with it.'''
+    if not fanout:
+        return [n for n in nodes if not n in down]
+
+    up = []
+    for head, subtree in relay_tree(nodes, fanout):
+        if not head in down:
+            up.append(head)
+            up.extend(reached(subtree, down, fanout))
+
+    return up
+
+async def collect(stream):
+    '''Return the (node, response) of an async stream as a list.'''
+    return [r async for r in stream]
+
+def check(result, what, got, expected):
+    '''Note in result if got is not what was expected.'''
+    if got != expected:
+        log.error('{} nodes: {} {}, expected {}'.format(result['nodes'], got, what, expected))
+        result.setdefault('errors', []).append('{}: {}, expected {}'.format(what, got, expected))
+
+def raise_fd_limit():
+    # One socket per node on each side.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def rss_mb():
+    with open('/proc/self/statm') as fd:
+        pages = int(fd.read().split()[1])
+
+    return pages * resource.getpagesize() / (1024 * 1024)
+
+def percentiles(samples, ps=(50, 90, 99)):
+    samples = sorted(samples)
+    if not samples:
+        return {p: 0.0 for p in ps}
+
+    return {p: samples[min(len(samples) - 1, int(len(samples) * p / 100))] for p in ps}
+
+def histogram_percentiles(histogram, ps=(50, 90, 99)):
+    return {p: histogram.percentile(p) or 0.0 for p in ps}
+
+def bench(count, args):
+    '''Run all benchmarks against a farm of count fake nodes and return the results.'''
+    nodes = fake_nodes(count)
+    # Spread over the nodes, so relayed calls lose some in every part of the tree.
+    down = nodes[::max(1, count // args.down)][:args.down] if args.down else []
+    # Spawned rather than forked, as grpc does not survive a fork once aio channels have been used.
+    mp = get_context('spawn')
+    ready, stop, kill, killed = mp.Event(), mp.Event(), mp.Event(), mp.Event()
+    servicer_args = (args.latency, args.jitter, args.straggler_rate, args.straggler_latency, args.failure_rate)
+    farm = mp.Process(target=run_farm, args=(nodes, args.port, args.servers, args.server_threads,
+                                             servicer_args, ready, stop, down, kill, killed))
+    farm.start()
+    ready.wait()
+
+    result = {'nodes': count, 'down': len(down)}
+    rss_before = rss_mb()
+    try:
+        start = time.monotonic()
+        iperf = IperfAgent(nodes, port=args.port)
+        result['load_s'] = time.monotonic() - start
+
+        # aio channels belong to the loop they were made on, so the async agent keeps to this one.
+        loop = asyncio.new_event_loop()
+        aiperf = loop.run_until_complete(AsyncIperfAgent(nodes, port=args.port).load()) if down else None
+
+        if down and not args.relay_fanout:
+            kill.set()
+            wait_until = time.monotonic() + 10
+            while len(iperf.unreachable()) < len(down) and time.monotonic() < wait_until:
+                time.sleep(0.1)
+        elif down:
+            # Only the heads of the relay tree are connected to, so wait for the nodes to go.
+            kill.set()
+            killed.wait()
+
+        latencies = []
+        failed = 0
+        unsuccessful = 0
+        start = time.monotonic()
+        for _ in range(args.calls):
+            call_start = time.monotonic()
+            responses = iperf.Configure(logdir='/tmp', timeout=args.timeout, completion=args.completion)
+            latencies.append(time.monotonic() - call_start)
+            failed += len(responses.failed())
+            unsuccessful += not responses.success()
+
+        elapsed = time.monotonic() - start
+        result['call_p'] = percentiles(latencies)
+        result['call_rpcs_per_s'] = count * args.calls / elapsed
+        result['call_failed'] = failed
+        result['call_unsuccessful'] = unsuccessful
+        if not args.failure_rate:
+            up = len(reached(nodes, down, args.relay_fanout))
+            succeeds = {
+                Completion.QUORUM: up >= count // 2 + 1,
+                Completion.FIRST: up >= 1,
+            }.get(args.completion, up == count)
+            check(result, 'calls not successful', unsuccessful, 0 if succeeds else args.calls)
+
+        # A failed stream ends the whole streaming call, so note it and move on.
+        messages = 0
+        first, gaps = LatencyHistogram(), LatencyHistogram()
+        last = {}
+        result['stream_failed'] = False
+        start = time.monotonic()
+        try:
+            for node, status in iperf.Status(count=args.stream_count):
+                messages += 1
+                now = time.monotonic()
+                if node in last:
+                    gaps.record(now - last[node])
+                else:
+                    first.record(now - start)
+                last[node] = now
+        except DistributedAgentException as e:
+            log.warning('Streaming call failed: {}'.format(e))
+            result['stream_failed'] = True
+
+        elapsed = time.monotonic() - start
+        result['stream_s'] = elapsed
+        result['stream_msgs_per_s'] = messages / elapsed
+        result['stream_first_p'] = histogram_percentiles(first)
+        result['stream_gap_p'] = histogram_percentiles(gaps)
+
+        # The streams of the down nodes fail, and either end the call or are yielded as errors.
+        if aiperf and not args.failure_rate:
+            try:
+                loop.run_until_complete(collect(aiperf.Status(count=args.stream_count)))
+                raised = False
+            except DistributedAgentException:
+                raised = True
+            check(result, 'async stream raised', raised, True)
+
+            got = loop.run_until_complete(collect(aiperf.Status(count=args.stream_count, yield_errors=True)))
+            failed_nodes = sorted(n for n, r in got if isinstance(r, grpc.RpcError))
+            check(result, 'async streams failed', failed_nodes, sorted(down))
+            check(result, 'async messages', len(got) - len(failed_nodes), (count - len(down)) * args.stream_count)
+
+        plan = DistributedAgentPlan()
+        for _ in range(args.plan_steps):
+            plan.add(iperf, 'Configure', logdir='/tmp')
+
+        start = time.monotonic()
+        steps = iperf.run_plan(plan, timeout=args.timeout)
+        result['plan_s'] = time.monotonic() - start
+        result['plan_failed'] = sum(len(r.failed()) + len(r.unfinished) for r in steps)
+        # Every step of a down node fails, and none of the others' steps may, bar injected failures.
+        if not args.failure_rate:
+            check(result, 'plan steps not successful', result['plan_failed'], len(down) * len(steps))
+        result['rss_mb'] = rss_mb()
+        result['rss_delta_mb'] = result['rss_mb'] - rss_before
+
+        iperf.close()
+        if aiperf:
+            loop.run_until_complete(aiperf.close())
+        loop.close()
+    finally:
+        stop.set()
+        farm.join()
+
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark DistributedAgent fan-out against fake local nodes.')
+    parser.add_argument('-n', '--nodes', type=str, default='1,10,100,1000',
+                        help='Comma separated list of node counts to run. Default=1,10,100,1000')
+    parser.add_argument('-p', '--port', type=int, default=52000, help='Port the fake nodes listen on.')
+    parser.add_argument('--servers', type=int, default=4, help='Number of grpc servers the nodes are spread over.')
+    parser.add_argument('--server-threads', type=int, default=64, help='Worker threads per grpc server.')
+    parser.add_argument('--calls', type=int, default=20, help='Number of blocking calls to time per node count.')
+    parser.add_argument('--stream-count', type=int, default=10, help='Messages per node in the streaming test.')
+    parser.add_argument('--plan-steps', type=int, default=3, help='Steps of the plan in the run_plan test.')
+    parser.add_argument('--down', type=int, default=0, help='Number of nodes that stop answering once loaded.')
+    parser.add_argument('--completion', type=str, default=Completion.ALL,
+                        choices=[Completion.ALL, Completion.QUORUM, Completion.FIRST, Completion.BEST_EFFORT],
+                        help='Completion policy of the blocking calls. Default=all')
+    parser.add_argument('--timeout', type=float, default=None, help='Timeout for each blocking call.')
+    parser.add_argument('--latency', type=float, default=0.001, help='Mean injected latency per call, in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Standard deviation of the injected latency.')
+    parser.add_argument('--straggler-rate', type=float, default=0.0, help='Fraction of calls that straggle.')
+    parser.add_argument('--straggler-latency', type=float, default=1.0, help='Extra latency of a straggler.')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of calls that fail.')
+    parser.add_argument('--max-workers', type=int, default=None, help='DistributedAgent max_workers.')
+    parser.add_argument('--relay-fanout', type=int, default=0,
+                        help='DistributedAgent relay fanout. The fake nodes relay to each other as agent '
+                             'servers do. A relaying node takes one of its server\'s threads for each '
+                             'level below it, so give deep trees enough --server-threads.')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Also write the results as JSON here.')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    if not args.verbose:
+        # Injected failures would otherwise log an error per node.
+        logging.getLogger('dgrpc').setLevel(logging.CRITICAL)
+    raise_fd_limit()
+
+    if args.max_workers:
+        DistributedAgent.set_max_workers(args.max_workers)
+
+    DistributedAgent.set_relay_fanout(args.relay_fanout)
+
+    print('{:>6} {:>8} {:>9} {:>9} {:>9} {:>11} {:>7} {:>9} {:>11} {:>8} {:>9} {:>8}'.format(
+        'nodes', 'load s', 'call p50', 'call p90', 'call p99', 'rpcs/s', 'failed', 'stream s', 'msgs/s',
+        'plan s', 'plan fail', 'rss MB'))
+    # A stream that failed part way is marked with a '!' after its time.
+    results = []
+    for count in [int(n) for n in args.nodes.split(',')]:
+        r = bench(count, args)
+        results.append(r)
+        print('{:>6} {:>8.3f} {:>9.4f} {:>9.4f} {:>9.4f} {:>11.0f} {:>7} {:>8.3f}{} {:>11.0f} {:>8.3f} {:>9} {:>8.1f}'.format(
+            r['nodes'], r['load_s'], r['call_p'][50], r['call_p'][90], r['call_p'][99], r['call_rpcs_per_s'],
+            r['call_failed'], r['stream_s'], '!' if r['stream_failed'] else ' ', r['stream_msgs_per_s'],
+            r['plan_s'], r['plan_failed'], r['rss_mb']))
+
+    # The streams' percentiles, as a table of their own to keep the lines short.
+    print()
+    print('{:>6} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'nodes', 'first p50', 'first p90', 'first p99', 'gap p50', 'gap p90', 'gap p99'))
+    for r in results:
+        print('{:>6} {:>9.4f} {:>9.4f} {:>9.4f} {:>9.4f} {:>9.4f} {:>9.4f}'.format(
+            r['nodes'], r['stream_first_p'][50], r['stream_first_p'][90], r['stream_first_p'][99],
+            r['stream_gap_p'][50], r['stream_gap_p'][90], r['stream_gap_p'][99]))
+
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(results, fd, indent=2)
+
+    errors = [e for r in results for e in r.get('errors', [])]
+    for e in errors:
+        print('ERROR: {}'.format(e))
+
+    exit(1 if errors else 0)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+'''
+Fetch the tcpdump captures of many nodes to local disk, all at once, using TcpdumpAgent.FetchDump
+rather than having every node copy its capture to a shared filesystem.
+
+Each node's capture is written to <outdir>/<node>-<file name>. A fetch that was cut short (or
+a capture that has grown since it was last fetched) is resumed from the end of the local file,
+so running this again only moves what is missing. At most --parallel nodes are fetched from at
+once; the rest wait their turn.
+
+    ./fetch_dumps.py -n vrouter.smalltest.edgect,ct1.smalltest.edgect -o /tmp/dumps --compress
+'''
+
+import argparse
+import logging
+import zlib
+from concurrent import futures
+from os import makedirs, path
+
+import grpc
+
+from dgrpc import tcpdump_agent_pb2 as pb
+from dgrpc.distributed_agent import DistributedAgent
+from dgrpc.tcpdump_agent import TcpdumpAgent, TcpdumpAgentException
+
+log = logging.getLogger(__name__)
+
+def fetch_node(agent, node, args, filename, timeout=None, retries=3):
+    '''Fetch the capture of node into filename, resuming from the end of filename if it exists.
+    A stream that fails is started again from where it stopped, up to retries times. Returns
+    (bytes fetched, comment); bytes fetched is None if the fetch did not finish.'''
+    mode = 'r+b' if path.exists(filename) else 'w+b'
+    fetched = 0
+    with open(filename, mode) as fd:
+        offset = fd.seek(0, 2)
+        for attempt in range(retries + 1):
+            request = pb.FetchArgs()
+            request.CopyFrom(args)
+            request.offset = offset
+            try:
+                for chunk in agent.agents[node].FetchDump(request, timeout=timeout):
+                    data = zlib.decompress(chunk.data) if chunk.compressed else chunk.data
+                    fd.seek(chunk.offset)
+                    fd.write(data)
+                    offset = chunk.offset + len(data)
+                    fetched += len(data)
+                    if offset >= chunk.size:
+                        # A capture that was restarted may now be shorter than the local copy.
+                        fd.truncate(offset)
+                        return fetched, 'Fetched {} bytes, {} total.'.format(fetched, offset)
+            except grpc.RpcError as e:
+                if e.code() in [grpc.StatusCode.NOT_FOUND, grpc.StatusCode.UNIMPLEMENTED]:
+                    return None, e.details()
+
+                if e.code() == grpc.StatusCode.OUT_OF_RANGE:
+                    # The capture is shorter than the local copy, so it is a new one. Start over.
+                    log.info('{}: capture is shorter than {}, fetching all of it.'.format(node, filename))
+                    offset = 0
+                    continue
+
+                log.warning('{}: fetch failed at {} bytes ({}), attempt {} of {}'.format(
+                    node, offset, e.details(), attempt + 1, retries + 1))
+
+    return None, 'Failed after {} attempts.'.format(retries + 1)
+
+def fetch_dumps(agent, outdir, filename=None, compress=False, chunk_size=0, timeout=None, retries=3, resume=True,
+                parallel=None):
+    '''Fetch the capture of every node of the TcpdumpAgent agent into outdir, from at most parallel
+    nodes at a time (default DistributedAgent.max_workers). Returns {node: (bytes fetched or None, comment)}.'''
+    makedirs(outdir, exist_ok=True)
+    args = pb.FetchArgs(filename=filename if filename else '', compress=compress, chunk_size=chunk_size)
+    name = path.basename(filename) if filename else 'tcpdump.cap'
+    results = {}
+    parallel = parallel if parallel else DistributedAgent.max_workers
+    with futures.ThreadPoolExecutor(max_workers=max(1, min(parallel, len(agent.nodes)))) as tpe:
+        calls = {}
+        for node in agent.nodes:
+            local = path.join(outdir, '{}-{}'.format(node, name))
+            if not resume and path.exists(local):
+                open(local, 'w').close()
+
+            calls[tpe.submit(fetch_node, agent, node, args, local, timeout, retries)] = node
+
+        for f in futures.as_completed(calls):
+            results[calls[f]] = f.result()
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fetch the tcpdump captures of many nodes to local disk.')
+    parser.add_argument('-n', '--nodes', type=str, required=True, help='Comma separated list of nodes.')
+    parser.add_argument('-p', '--port', type=int, default=51000, help='Port the agent servers listen on.')
+    parser.add_argument('-o', '--outdir', type=str, default='.', help='Where to write the captures.')
+    parser.add_argument('-f', '--file', type=str, default=None,
+                        help='The capture file on the nodes. Default is the dumpfile the agent was configured with.')
+    parser.add_argument('-z', '--compress', action='store_true', help='Compress the captures in transit.')
+    parser.add_argument('--chunk-size', type=int, default=0, help='Bytes per chunk. Default=1MB')
+    parser.add_argument('--timeout', type=float, default=None, help='Timeout of each fetch, in seconds.')
+    parser.add_argument('--retries', type=int, default=3, help='Times to resume a fetch that failed.')
+    parser.add_argument('--parallel', type=int, default=DistributedAgent.max_workers,
+                        help='Most nodes to fetch from at once. Default={}'.format(DistributedAgent.max_workers))
+    parser.add_argument('--no-resume', action='store_true', help='Fetch whole captures, even if partly fetched before.')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)-15s %(levelname)-8s %(message)s')
+
+    agent = None
+    try:
+        agent = TcpdumpAgent(args.nodes.split(','), port=args.port)
+        results = fetch_dumps(agent, args.outdir, args.file, args.compress, args.chunk_size,
+                              args.timeout, args.retries, not args.no_resume, args.parallel)
+    except TcpdumpAgentException as e:
+        log.critical(e)
+        if agent:
+            agent.close()
+        exit(1)
+
+    agent.close()
+    failed = [n for n, (fetched, _) in results.items() if fetched is None]
+    for node, (_, comment) in sorted(results.items()):
+        log.info('{}: {}'.format(node, comment))
+
+    exit(1 if failed else 0)
@@ -6,6 +6,7 @@ import time
 from dgrpc.tcpdump_agent import TcpdumpAgent, TcpdumpAgentException
 from dgrpc.http_server_agent import HttpServerAgent, HttpServerAgentException
 from dgrpc.http_client_agent import HttpClientAgent, HttpClientAgentException
+from dgrpc.distributed_agent import Completion
 
 log = logging.getLogger(__name__)
 logging.basicConfig(
@@ -25,6 +26,10 @@ if __name__ == '__main__':
     tcpdump = TcpdumpAgent(tcpdump_nodes_fqdn)
     curl = HttpClientAgent(curl_nodes_fqdn)
 
+    # do not let a single hung node stall the experiment.
+    for agent in [apache, tcpdump, curl]:
+        agent.timeout = 30
+
     def clean_and_exit(msg):
         log.critical(msg)
         apache.close()
@@ -59,7 +64,9 @@ if __name__ == '__main__':
     if not responses.success():
         clean_and_exit('Error stopping tcpdump collection: {}'.format(responses.status()))
 
-    responses = tcpdump.ArchiveDump(path='/zfs/edgelab/glawler/tcpdumps', tag='GTL')
+    # Keep whatever captures we can get.
+    responses = tcpdump.ArchiveDump(path='/zfs/edgelab/glawler/tcpdumps', tag='GTL', timeout=120,
+                                    completion=Completion.BEST_EFFORT)
     if not responses.success():
         clean_and_exit('Error archiving tcpdump packet files: {}'.format(responses.status()))
 
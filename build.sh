@@ -4,6 +4,8 @@ PROTO_DIR=proto
 PACKAGE_DIR=dgrpc
 PROTOC3ZIP=./sources/protoc-3.5.1-linux-x86_64.zip
 DGRPC_PARSER=./bin/dgrpc_parser.py
+# Set DGRPC_OPTS=async to generate asyncio servicer templates (for agent_server.py --asyncio).
+DGRPC_OPTS=${DGRPC_OPTS:-}
 # we use protoc3 to support protobuf 3 syntax even though we don't really use it.
 PROTOC=/usr/local/bin/protoc3
 
@@ -46,12 +48,15 @@ echo Generating distributed agent client and server side code.
 ${PROTOC} \
     -I ${PROTO_DIR} \
     --plugin=protoc-gen-dgrpc=${DGRPC_PARSER} \
-    --dgrpc_out=${PACKAGE_DIR} \
+    --dgrpc_out=${DGRPC_OPTS:+${DGRPC_OPTS}:}${PACKAGE_DIR} \
     ${PROTO_DIR}/${PACKAGE_DIR}/*.proto
 
 echo Overwriting servicer templates with working servicers from staging...
 cp -v staging/*_servicer.py ${PACKAGE_DIR}
 
+# Modules the servicers use.
+cp -v staging/pcap.py staging/netroute.py ${PACKAGE_DIR}
+
 # hack for extra files for apache. This will be cleaned up somehow.
 cp -v staging/traffic_gen* ${PACKAGE_DIR}
 
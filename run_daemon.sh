@@ -14,6 +14,7 @@ elif [[ $1 == restart ]]; then
     pkill -f agent_server.py
 fi
 
-PYTHONPATH=${DIR}/dgrpc:${DIR}/dgrpc/pb ${DIR}/bin/agent_server.py -c ${DIR}/etc/dgrpc.conf > /tmp/dgrpc.log 2>&1 &
+# Extra agent_server.py arguments, i.e. AGENT_SERVER_ARGS=--asyncio
+PYTHONPATH=${DIR}/dgrpc:${DIR}/dgrpc/pb ${DIR}/bin/agent_server.py -c ${DIR}/etc/dgrpc.conf ${AGENT_SERVER_ARGS} > /tmp/dgrpc.log 2>&1 &
 
 exit 0
@@ -0,0 +1,289 @@
+'''
+Find the interface that routes to a destination, or that has an address, from the kernel's
+routing and address tables rather than by running "ip route get" each time. The tables are read
+from /proc/net once and kept until the kernel announces a change to routes, addresses or links on
+a netlink socket. Destination names are resolved once per dns_ttl seconds.
+
+    routes = Resolver()
+    iface = routes.dest2iface('traf21')
+'''
+
+import errno
+import logging
+import socket
+import struct
+from subprocess import check_output, CalledProcessError
+from threading import Lock
+from time import time
+
+from netifaces import interfaces, ifaddresses
+
+log = logging.getLogger(__name__)
+
+# Route flags, from linux/route.h.
+_RTF_UP = 0x0001
+_RTF_REJECT = 0x0200
+
+# Netlink groups of route, address and link changes, from linux/rtnetlink.h.
+_RTMGRP_LINK = 0x1
+_RTMGRP_IPV4_IFADDR = 0x10
+_RTMGRP_IPV4_ROUTE = 0x40
+_RTMGRP_IPV6_IFADDR = 0x100
+_RTMGRP_IPV6_ROUTE = 0x400
+_RTMGRP_CHANGES = _RTMGRP_LINK | _RTMGRP_IPV4_IFADDR | _RTMGRP_IPV4_ROUTE | _RTMGRP_IPV6_IFADDR | _RTMGRP_IPV6_ROUTE
+
+class Route:
+    '''One entry of a routing table. network and mask are ints of the address family's size.'''
+    __slots__ = ('network', 'mask', 'prefixlen', 'metric', 'iface', 'reject')
+
+    def __init__(self, network, prefixlen, metric, iface, reject=False, bits=32):
+        self.mask = ((1 << prefixlen) - 1) << (bits - prefixlen)
+        self.network = network & self.mask
+        self.prefixlen = prefixlen
+        self.metric = metric
+        self.iface = iface
+        self.reject = reject
+
+def read_routes(filename='/proc/net/route'):
+    '''The IPv4 routes of the main table, most specific first.'''
+    routes = []
+    with open(filename) as fd:
+        next(fd)    # the column names.
+        for line in fd:
+            fields = line.split()
+            if len(fields) < 8:
+                continue
+
+            flags = int(fields[3], 16)
+            if not flags & _RTF_UP:
+                continue
+
+            # Addresses are printed as the hex of the network order bytes read as a host int.
+            dest = int.from_bytes(struct.pack('=I', int(fields[1], 16)), 'big')
+            mask = int.from_bytes(struct.pack('=I', int(fields[7], 16)), 'big')
+            routes.append(Route(dest, bin(mask).count('1'), int(fields[6]), fields[0], bool(flags & _RTF_REJECT)))
+
+    return _sorted(routes)
+
+def read_ipv6_routes(filename='/proc/net/ipv6_route'):
+    '''The IPv6 routes of all tables, most specific first.'''
+    routes = []
+    with open(filename) as fd:
+        for line in fd:
+            fields = line.split()
+            if len(fields) < 10:
+                continue
+
+            flags = int(fields[8], 16)
+            if not flags & _RTF_UP:
+                continue
+
+            routes.append(Route(int(fields[0], 16), int(fields[1], 16), int(fields[5], 16), fields[9],
+                                bool(flags & _RTF_REJECT), bits=128))
+
+    return _sorted(routes)
+
+def read_addresses():
+    '''{address in packed form: interface} of the addresses of all interfaces.'''
+    addresses = {}
+    for iface in interfaces():
+        for family, addrs in ifaddresses(iface).items():
+            if family not in [socket.AF_INET, socket.AF_INET6]:
+                continue
+
+            for addr in addrs:
+                # IPv6 link local addresses have the interface after a %.
+                packed = _pack(addr['addr'].split('%')[0])
+                if packed:
+                    addresses.setdefault(packed, iface)
+
+    return addresses
+
+def _sorted(routes):
+    return sorted(routes, key=lambda r: (-r.prefixlen, r.metric))
+
+def _pack(address):
+    '''The packed form of an IPv4 or IPv6 address, or None if it is not one.'''
+    for family in [socket.AF_INET, socket.AF_INET6]:
+        try:
+            return socket.inet_pton(family, address)
+        except (OSError, ValueError):
+            pass
+
+    return None
+
+class Resolver:
+    '''Interfaces of destinations and addresses, from cached copies of the kernel's tables. The
+    tables are read again after a route, address or link changes, which is learned from netlink,
+    or every table_ttl seconds where netlink is not available. Safe to share between threads.'''
+    # Seconds to keep a destination's address, and the tables when there is no netlink.
+    dns_ttl = 60
+    table_ttl = 30
+
+    def __init__(self):
+        self._lock = Lock()
+        self._netlink = None
+        self._netlink_failed = False
+        self._loaded = 0
+        self._routes = []
+        self._ipv6_routes = []
+        self._addresses = {}
+        # destination name -> (address, time resolved)
+        self._names = {}
+        # packed address -> interface, for addresses already looked up.
+        self._found = {}
+
+    def dest2iface(self, destination):
+        '''The interface that routes to destination, a name or address, or None.'''
+        addr = self.resolve(destination)
+        if not addr:
+            return None
+
+        packed = _pack(addr)
+        with self._lock:
+            self._refresh()
+            if packed in self._found:
+                return self._found[packed]
+
+            iface = self._route(packed)
+
+        if iface is None:
+            # i.e. policy routing, which /proc/net/route does not show.
+            iface = self._ip_route_get(addr)
+
+        with self._lock:
+            self._found[packed] = iface
+
+        return iface
+
+    def addr2iface(self, address):
+        '''The interface that has address, or None.'''
+        packed = _pack(address)
+        if not packed:
+            return None
+
+        with self._lock:
+            self._refresh()
+            return self._addresses.get(packed)
+
+    def resolve(self, destination):
+        '''The address of destination, preferring IPv4, or None if it does not resolve.'''
+        if _pack(destination):
+            return destination
+
+        now = time()
+        with self._lock:
+            cached = self._names.get(destination)
+        if cached and now - cached[1] < self.dns_ttl:
+            return cached[0]
+
+        try:
+            infos = socket.getaddrinfo(destination, None, type=socket.SOCK_DGRAM)
+        except socket.gaierror as e:
+            log.critical('Unable to get address for {}: {}'.format(destination, e))
+            return None
+
+        infos.sort(key=lambda i: i[0] != socket.AF_INET)
+        addr = infos[0][4][0]
+        with self._lock:
+            self._names[destination] = (addr, now)
+
+        return addr
+
+    def invalidate(self):
+        '''Read the tables again on the next lookup.'''
+        with self._lock:
+            self._loaded = 0
+
+    def _refresh(self):
+        '''Read the tables if they changed since they were read. Called with the lock held.'''
+        if self._changed() or (not self._netlink and time() - self._loaded > self.table_ttl):
+            self._loaded = 0
+
+        if self._loaded:
+            return
+
+        try:
+            self._routes = read_routes()
+        except OSError as e:
+            log.warning('Unable to read IPv4 routes: {}'.format(e))
+            self._routes = []
+        try:
+            self._ipv6_routes = read_ipv6_routes()
+        except OSError as e:
+            log.warning('Unable to read IPv6 routes: {}'.format(e))
+            self._ipv6_routes = []
+
+        self._addresses = read_addresses()
+        self._found = {}
+        self._loaded = time()
+        log.debug('read {} IPv4 routes, {} IPv6 routes and {} addresses'.format(
+            len(self._routes), len(self._ipv6_routes), len(self._addresses)))
+
+    def _changed(self):
+        '''True if netlink announced a change since the last call, or there is no netlink to ask.'''
+        if not self._netlink:
+            if self._netlink_failed:
+                return False
+
+            try:
+                self._netlink = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+                self._netlink.bind((0, _RTMGRP_CHANGES))
+                self._netlink.setblocking(False)
+            except (OSError, AttributeError) as e:
+                log.info('No netlink ({}), reading routes every {}s.'.format(e, self.table_ttl))
+                self._netlink = None
+                self._netlink_failed = True
+                return False
+
+            # Changes from before the socket was opened are not known.
+            return True
+
+        changed = False
+        while True:
+            try:
+                self._netlink.recv(65536)
+                changed = True
+            except BlockingIOError:
+                return changed
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    # More changes than the socket holds, some were dropped.
+                    changed = True
+                    continue
+
+                # The tables are read every table_ttl seconds from now on.
+                log.warning('Netlink failed ({}), reading routes every {}s.'.format(e, self.table_ttl))
+                self._netlink.close()
+                self._netlink = None
+                self._netlink_failed = True
+                return True
+
+    def _route(self, packed):
+        '''The interface of the most specific route to the packed address, or None.'''
+        if packed in self._addresses:
+            # The kernel routes an address of this host over loopback.
+            return 'lo'
+
+        routes = self._routes if len(packed) == 4 else self._ipv6_routes
+        addr = int.from_bytes(packed, 'big')
+        for route in routes:
+            if addr & route.mask == route.network:
+                return None if route.reject else route.iface
+
+        return None
+
+    def _ip_route_get(self, addr):
+        cmd = 'ip route get {}'.format(addr)
+        try:
+            out = check_output(cmd.split()).decode("utf-8")   # out ==> bytes to str
+        except (OSError, CalledProcessError) as e:
+            log.critical('Error invoking "{}": {}'.format(cmd, e))
+            return None
+
+        line = out.split('\n')[0].split()
+        if 'dev' not in line:
+            log.critical('Unable to find device name in ip route output: {}'.format(line))
+            return None
+
+        return line[line.index('dev') + 1]  # dev name is always just after "dev"
@@ -0,0 +1,437 @@
+'''
+Read pcap files, as written by tcpdump -w, and summarize them into per flow counts. Files are
+read through mmap, one record at a time, so they are never read into memory whole and a file
+still being written can be read up to its last complete record.
+'''
+
+import logging
+import mmap
+import struct
+from array import array
+from os import fstat, stat
+from socket import AF_INET, AF_INET6, inet_ntop
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+# Magic numbers of captures with microsecond and nanosecond timestamps.
+_MAGIC_USEC = 0xa1b2c3d4
+_MAGIC_NSEC = 0xa1b23c4d
+
+HEADER_SIZE = 24
+RECORD_HEADER_SIZE = 16
+
+# Link types tcpdump writes. Captures on "-i any" are LINUX_SLL or, with newer tcpdump, LINUX_SLL2.
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+# OpenBSD's raw IP link type.
+_LINKTYPE_RAW_OLD = 12
+
+_ETHERTYPE_IPV4 = 0x0800
+_ETHERTYPE_IPV6 = 0x86dd
+_ETHERTYPE_IPS = frozenset([_ETHERTYPE_IPV4, _ETHERTYPE_IPV6])
+_ETHERTYPE_VLANS = frozenset([0x8100, 0x88a8, 0x9100])
+
+# IP protocols with ports in their first four bytes: TCP, UDP, SCTP, UDP-Lite.
+_PORT_PROTOCOLS = frozenset([6, 17, 132, 136])
+# IPv6 extension headers that are skipped to find the protocol: hop-by-hop, routing, destination.
+_IPV6_OPTIONS = frozenset([0, 43, 60])
+_IPV6_FRAGMENT = 44
+
+_NO_PORTS = b'\0\0\0\0'
+
+_u16 = struct.Struct('>H')
+
+# Summaries with interval counts are at most this many counts, per flow and interval.
+MAX_INTERVAL_CELLS = 50 * 1000 * 1000
+# Packets held for the interval counts before they are added to the totals.
+_INTERVAL_BATCH = 1024 * 1024
+
+class PcapError(Exception):
+    pass
+
+class PcapReader:
+    '''The records of a pcap file. Only the header is read when opened; records() then walks the
+    file one record at a time, so a capture of any size can be read:
+
+        with PcapReader('/tmp/tcpdump.cap') as pcap:
+            for ts, length, caplen, offset in pcap.records():
+                ethernet = pcap.buffer[offset:offset + 14]
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = open(filename, 'rb')
+        try:
+            if fstat(self._fd.fileno()).st_size < HEADER_SIZE:
+                raise PcapError('{} is too short to be a pcap file.'.format(filename))
+
+            self.buffer = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._fd.close()
+            raise
+
+        endian, self.nsec = read_header(self.buffer[:HEADER_SIZE], filename)
+        self.snaplen, self.linktype = struct.unpack_from(endian + 'II', self.buffer, 16)
+        self._record = struct.Struct(endian + 'IIII')
+        # Set by records() if the file ends part way through a record, as a live capture may.
+        self.truncated = False
+
+    def records(self, offset=HEADER_SIZE):
+        '''Yield (timestamp, length on the wire, captured length, offset of the packet in buffer) of
+        each record, starting at the record at offset.'''
+        buf = self.buffer
+        size = len(buf)
+        unpack = self._record.unpack_from
+        scale = 1e-9 if self.nsec else 1e-6
+        while offset + RECORD_HEADER_SIZE <= size:
+            sec, frac, caplen, length = unpack(buf, offset)
+            data = offset + RECORD_HEADER_SIZE
+            if data + caplen > size:
+                break
+
+            yield sec + frac * scale, length, caplen, data
+            offset = data + caplen
+
+        self.truncated = offset != size
+
+    def close(self):
+        self.buffer.close()
+        self._fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class PcapFollower:
+    '''Running counts of a pcap file that is still being written. Each read() walks only the
+    records added since the one before, so a live capture can be watched for the cost of its new
+    record headers. A file that is replaced or rewritten, as when tcpdump is restarted, is counted
+    again from its start.'''
+    def __init__(self, filename):
+        self.filename = filename
+        self._reset(None)
+
+    def _reset(self, inode):
+        self.packets = 0
+        self.bytes = 0
+        self.size = 0
+        # Timestamp of the last packet read.
+        self.last = 0.0
+        self._inode = inode
+        self._offset = HEADER_SIZE
+        # Where the last record read starts, and its header, to tell if the file was rewritten.
+        self._last_at = None
+        self._last_header = None
+
+    def read(self):
+        '''Return (packets, bytes on the wire) of the complete records written since the last read.'''
+        try:
+            st = stat(self.filename)
+        except FileNotFoundError:
+            self._reset(None)
+            return 0, 0
+
+        if st.st_ino != self._inode or st.st_size < self.size:
+            self._reset(st.st_ino)
+
+        self.size = st.st_size
+        if self.size < self._offset + RECORD_HEADER_SIZE:
+            return 0, 0
+
+        packets, nbytes = 0, 0
+        with PcapReader(self.filename) as pcap:
+            buf = pcap.buffer
+            if self._last_at is not None and buf[self._last_at:self._last_at + RECORD_HEADER_SIZE] != self._last_header:
+                log.info('{} was rewritten, counting it from the start.'.format(self.filename))
+                self._reset(st.st_ino)
+                self.size = len(buf)
+
+            for ts, length, caplen, offset in pcap.records(self._offset):
+                packets += 1
+                nbytes += length
+
+            if packets:
+                self._last_at = offset - RECORD_HEADER_SIZE
+                self._last_header = buf[self._last_at:offset]
+                self._offset = offset + caplen
+                self.last = ts
+
+        self.packets += packets
+        self.bytes += nbytes
+        return packets, nbytes
+
+def read_header(header, filename=''):
+    '''Return (struct byte order, True if nanosecond timestamps) of a pcap file header.'''
+    for endian in '<>':
+        magic = struct.unpack_from(endian + 'I', header)[0]
+        if magic in [_MAGIC_USEC, _MAGIC_NSEC]:
+            return endian, magic == _MAGIC_NSEC
+
+    raise PcapError('{} is not a pcap file (pcapng is not read).'.format(filename))
+
+def ip_offset(buf, offset, caplen, linktype):
+    '''Return the offset of the IP header of the packet at offset, or None if it is not IP.'''
+    if linktype == LINKTYPE_ETHERNET:
+        ethertype_at = offset + 12
+        ethertype = _u16.unpack_from(buf, ethertype_at)[0] if caplen >= 14 else None
+        while ethertype in _ETHERTYPE_VLANS and ethertype_at + 6 <= offset + caplen:
+            ethertype_at += 4
+            ethertype = _u16.unpack_from(buf, ethertype_at)[0]
+
+        ip = ethertype_at + 2
+    elif linktype == LINKTYPE_LINUX_SLL:
+        ethertype = _u16.unpack_from(buf, offset + 14)[0] if caplen >= 16 else None
+        ip = offset + 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        ethertype = _u16.unpack_from(buf, offset)[0] if caplen >= 20 else None
+        ip = offset + 20
+    elif linktype == LINKTYPE_NULL:
+        # The address family, in the byte order of the capturing host. IPv6 is 24, 28 or 30.
+        family = max(buf[offset], buf[offset + 3]) if caplen >= 4 else None
+        ethertype = _ETHERTYPE_IPV4 if family == 2 else _ETHERTYPE_IPV6 if family in [24, 28, 30] else None
+        ip = offset + 4
+    elif linktype in [LINKTYPE_RAW, _LINKTYPE_RAW_OLD, LINKTYPE_IPV4, LINKTYPE_IPV6]:
+        version = buf[offset] >> 4 if caplen else None
+        ethertype = _ETHERTYPE_IPV4 if version == 4 else _ETHERTYPE_IPV6 if version == 6 else None
+        ip = offset
+    else:
+        return None
+
+    return ip if ethertype in _ETHERTYPE_IPS else None
+
+def flow_key(buf, ip, end):
+    '''Return the 5-tuple of the IP packet at ip, which ends at end, as bytes: the IP version,
+    the protocol, the source and destination addresses and the source and destination ports.
+    Ports are 0 if the protocol has none or the packet is a later fragment. Returns None if the
+    packet is too short to have the addresses. See decode_flow_key().'''
+    if ip >= end:
+        return None
+
+    version = buf[ip] >> 4
+    if version == 4:
+        if ip + 20 > end:
+            return None
+
+        protocol = buf[ip + 9]
+        l4 = ip + (buf[ip] & 0x0f) * 4
+        later_fragment = _u16.unpack_from(buf, ip + 6)[0] & 0x1fff
+        addresses = buf[ip + 12:ip + 20]
+    elif version == 6:
+        if ip + 40 > end:
+            return None
+
+        protocol = buf[ip + 6]
+        l4 = ip + 40
+        later_fragment = False
+        while protocol in _IPV6_OPTIONS and l4 + 8 <= end:
+            protocol, l4 = buf[l4], l4 + (buf[l4 + 1] + 1) * 8
+        if protocol == _IPV6_FRAGMENT and l4 + 8 <= end:
+            later_fragment = _u16.unpack_from(buf, l4 + 2)[0] & 0xfff8
+            protocol, l4 = buf[l4], l4 + 8
+
+        addresses = buf[ip + 8:ip + 40]
+    else:
+        return None
+
+    if protocol in _PORT_PROTOCOLS and not later_fragment and l4 + 4 <= end:
+        ports = buf[l4:l4 + 4]
+    else:
+        ports = _NO_PORTS
+
+    return bytes((version, protocol)) + addresses + ports
+
+def decode_flow_key(key):
+    '''Return (protocol, source, source port, destination, destination port) of a flow_key().'''
+    family, size = (AF_INET, 4) if key[0] == 4 else (AF_INET6, 16)
+    src = inet_ntop(family, key[2:2 + size])
+    dst = inet_ntop(family, key[2 + size:2 + 2 * size])
+    sport, dport = struct.unpack_from('>HH', key, 2 + 2 * size)
+    return key[1], src, sport, dst, dport
+
+class Flow:
+    '''Counts of one direction of a 5-tuple. If the summary has an interval, interval_packets and
+    interval_bytes count the flow in each interval from the first packet of the capture.'''
+    __slots__ = ('protocol', 'src', 'sport', 'dst', 'dport', 'packets', 'bytes', 'first', 'last',
+                 'interval_packets', 'interval_bytes')
+
+    def __init__(self, key, counts):
+        self.protocol, self.src, self.sport, self.dst, self.dport = decode_flow_key(key)
+        _, self.packets, self.bytes, self.first, self.last = counts
+        self.interval_packets = []
+        self.interval_bytes = []
+
+class Summary:
+    '''The flows of a capture and totals over all of its packets. Packets that are not IP are
+    only counted in the totals, as other_packets.'''
+    def __init__(self):
+        self.flows = []
+        self.flow_count = 0
+        self.packets = 0
+        self.bytes = 0
+        self.other_packets = 0
+        self.start = 0.0
+        self.end = 0.0
+        self.interval = 0.0
+        self.truncated = False
+
+def summarize(filename, interval=0.0, top=0):
+    '''Summarize the pcap file into flows, largest (in bytes) first. If top, only that many of
+    the largest are kept. If interval, each flow is also counted per interval of that many
+    seconds; this uses numpy when it is installed. Lengths are of the packets on the wire, not
+    of what was captured of them.'''
+    summary = Summary()
+    # flow key -> [index, packets, bytes, first, last]
+    flows = {}
+    cells = _IntervalCounts(interval)
+    ids, times, lengths = cells.ids, cells.times, cells.lengths
+    with PcapReader(filename) as pcap:
+        buf = pcap.buffer
+        linktype = pcap.linktype
+        for ts, length, caplen, offset in pcap.records():
+            summary.packets += 1
+            summary.bytes += length
+            if summary.packets == 1:
+                cells.origin = ts
+            # Records are not always in time order.
+            if summary.packets == 1 or ts < summary.start:
+                summary.start = ts
+            if ts > summary.end:
+                summary.end = ts
+
+            ip = ip_offset(buf, offset, caplen, linktype)
+            key = flow_key(buf, ip, offset + caplen) if ip is not None else None
+            if key is None:
+                summary.other_packets += 1
+                continue
+
+            counts = flows.get(key)
+            if counts is None:
+                counts = flows[key] = [len(flows), 0, 0, ts, ts]
+
+            counts[1] += 1
+            counts[2] += length
+            if ts < counts[3]:
+                counts[3] = ts
+            if ts > counts[4]:
+                counts[4] = ts
+            if interval:
+                ids.append(counts[0])
+                times.append(ts)
+                lengths.append(length)
+                if len(ids) >= _INTERVAL_BATCH:
+                    cells.flush()
+
+        summary.truncated = pcap.truncated
+
+    summary.flow_count = len(flows)
+    largest = sorted(flows.items(), key=lambda f: f[1][2], reverse=True)
+    if top:
+        largest = largest[:top]
+
+    summary.flows = [Flow(key, counts) for key, counts in largest]
+    if interval and summary.packets:
+        summary.interval = interval
+        _count_intervals(summary, [counts[0] for _, counts in largest], len(flows), cells)
+
+    return summary
+
+class _IntervalCounts:
+    '''Packet and byte totals per flow index and interval. Packets are appended to ids, times and
+    lengths and added to the totals a batch at a time by flush(), so memory grows with the flows
+    and intervals that have packets rather than with the packets. Intervals are from origin, the
+    first packet; packets from before it (records are not always in time order) are counted in
+    the first interval.'''
+    def __init__(self, interval):
+        self.interval = interval
+        self.origin = 0.0
+        self.ids, self.times, self.lengths = array('I'), array('d'), array('I')
+        if numpy is not None:
+            # (flow index << 32 | interval), sorted, and the packets and bytes of each.
+            self.keys = numpy.zeros(0, dtype=numpy.uint64)
+            self.packets = numpy.zeros(0, dtype=numpy.int64)
+            self.bytes = numpy.zeros(0, dtype=numpy.int64)
+        else:
+            # (flow index, interval) -> [packets, bytes]
+            self.totals = {}
+
+    def flush(self):
+        '''Add the packets appended since the last flush to the totals.'''
+        if not self.ids:
+            return
+
+        if numpy is not None:
+            bins = numpy.maximum((numpy.frombuffer(self.times, dtype=numpy.float64) - self.origin) / self.interval, 0)
+            keys = numpy.frombuffer(self.ids, dtype=numpy.uint32).astype(numpy.uint64) << numpy.uint64(32)
+            keys |= bins.astype(numpy.uint64)
+            # Copies, as the arrays are emptied below and cannot be while viewed.
+            lengths = numpy.frombuffer(self.lengths, dtype=numpy.uint32).astype(numpy.int64)
+            # Each cell once, with the totals so far and of this batch summed.
+            keys, inverse = numpy.unique(numpy.concatenate([self.keys, keys]), return_inverse=True)
+            ones = numpy.ones(len(self.ids), dtype=numpy.int64)
+            self.packets = numpy.bincount(inverse, weights=numpy.concatenate([self.packets, ones]),
+                                          minlength=len(keys)).astype(numpy.int64)
+            self.bytes = numpy.bincount(inverse, weights=numpy.concatenate([self.bytes, lengths]),
+                                        minlength=len(keys)).astype(numpy.int64)
+            self.keys = keys
+        else:
+            totals = self.totals
+            for flow_id, ts, length in zip(self.ids, self.times, self.lengths):
+                i = int((ts - self.origin) / self.interval) if ts > self.origin else 0
+                cell = totals.get((flow_id, i))
+                if cell is None:
+                    totals[(flow_id, i)] = [1, length]
+                else:
+                    cell[0] += 1
+                    cell[1] += length
+
+        # Emptied in place, as summarize() appends to them.
+        del self.ids[:], self.times[:], self.lengths[:]
+
+def _count_intervals(summary, flow_ids, flow_count, cells):
+    '''Fill in the interval counts of summary.flows, whose flow indexes are flow_ids, from the
+    _IntervalCounts cells.'''
+    intervals = int((summary.end - cells.origin) / summary.interval) + 1
+    if len(flow_ids) * intervals > MAX_INTERVAL_CELLS:
+        raise PcapError('{} flows over {} intervals is too many counts. Ask for fewer flows or a longer interval.'.format(
+            len(flow_ids), intervals))
+
+    cells.flush()
+    if numpy is not None:
+        rows = numpy.full(flow_count, -1, dtype=numpy.int64)
+        rows[flow_ids] = numpy.arange(len(flow_ids))
+        cell_rows = rows[(cells.keys >> numpy.uint64(32)).astype(numpy.int64)]
+        keep = cell_rows >= 0
+        bins = (cells.keys[keep] & numpy.uint64(0xffffffff)).astype(numpy.int64)
+        packets = numpy.zeros((len(flow_ids), intervals), dtype=numpy.int64)
+        nbytes = numpy.zeros((len(flow_ids), intervals), dtype=numpy.int64)
+        packets[cell_rows[keep], bins] = cells.packets[keep]
+        nbytes[cell_rows[keep], bins] = cells.bytes[keep]
+        for flow, p, b in zip(summary.flows, packets, nbytes):
+            flow.interval_packets = p.tolist()
+            flow.interval_bytes = b.tolist()
+
+        return
+
+    rows = {flow_id: row for row, flow_id in enumerate(flow_ids)}
+    packets = [[0] * intervals for _ in flow_ids]
+    nbytes = [[0] * intervals for _ in flow_ids]
+    for (flow_id, i), (p, b) in cells.totals.items():
+        row = rows.get(flow_id)
+        if row is not None:
+            packets[row][i] = p
+            nbytes[row][i] = b
+
+    for flow, p, b in zip(summary.flows, packets, nbytes):
+        flow.interval_packets = p
+        flow.interval_bytes = b
@@ -1,17 +1,146 @@
+import gzip
 import logging
-from os.path import exists, isdir, basename, join as path_join
-from os import makedirs
-from time import sleep, strftime
-from shutil import copyfile
-from subprocess import Popen, STDOUT, check_output, CalledProcessError
-from netifaces import interfaces, ifaddresses
-from socket import AF_INET, gethostbyname, gethostname
+import re
+import zlib
+from os.path import exists, isdir, basename, dirname, join as path_join
+from os import fstat, listdir, makedirs, rename, stat, unlink
+from time import sleep, strftime, time
+from shutil import copyfile, copyfileobj
+from threading import Event, Thread
+from subprocess import Popen, STDOUT
+from socket import gethostname
+
+import grpc
 
 from . import tcpdump_agent_pb2 as pb
 from . import tcpdump_agent_pb2_grpc as pb_grpc
+from . import netroute
+from . import pcap
 
 log = logging.getLogger(__name__)
 
+# FetchDump chunk sizes. Large chunks keep the per message overhead down; the limit keeps them
+# well under the grpc message size limit.
+_CHUNK_SIZE = 1024 * 1024
+_MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Seconds between Status messages, by default and at least.
+_STATUS_INTERVAL = 1.0
+_MIN_STATUS_INTERVAL = 0.1
+
+class _SegmentRing:
+    '''The segments of a capture that tcpdump is rotating, and a thread that deals with each one
+    once tcpdump has moved on to the next: it is gzipped into archive_path, if given, and the
+    oldest are removed so that no more than keep are left on the node.'''
+    # Seconds between looks for finished segments.
+    poll = 1.0
+
+    def __init__(self, dumpfile, timed, keep=0, archive_path=None, prefix=''):
+        self.dumpfile = dumpfile
+        # The -w argument. tcpdump appends a count to the name of each segment of a -C capture.
+        self.template = dumpfile + '.%Y%m%d-%H%M%S' if timed else dumpfile
+        self.keep = keep
+        self.archive_path = archive_path
+        self.prefix = prefix
+        self.archived = 0
+        self.removed = 0
+        self.failed = 0
+        self._pattern = re.compile(re.escape(basename(dumpfile)) + (r'\.(\d{8}-\d{6})' if timed else '()') + r'(\d*)$')
+        self._started = time()
+        # Finished segments that are staying on the node.
+        self._finished = set()
+        self._stopping = Event()
+        self._thread = Thread(target=self._run, name='segment-ring', daemon=True)
+        self._thread.start()
+
+    def segments(self):
+        '''Paths of the segments of this capture, oldest first.'''
+        directory = dirname(self.dumpfile) or '.'
+        found = []
+        for name in listdir(directory):
+            m = self._pattern.match(name)
+            if not m:
+                continue
+
+            filename = path_join(directory, name)
+            try:
+                # Segments older than the capture are from an earlier one.
+                if stat(filename).st_mtime < self._started - 1:
+                    continue
+            except FileNotFoundError:
+                continue
+
+            found.append(((m.group(1), int(m.group(2) or 0)), filename))
+
+        return [filename for _, filename in sorted(found)]
+
+    def live(self):
+        '''The segment tcpdump is writing.'''
+        segments = self.segments()
+        return segments[-1] if segments else self.dumpfile
+
+    def stop(self):
+        '''Deal with the segments left, including the last. Call once tcpdump has stopped.'''
+        self._stopping.set()
+        self._thread.join()
+        comment = 'Archived {} segments to {}.'.format(self.archived, self.archive_path) if self.archive_path else ''
+        if self.removed:
+            comment += ' Removed {} segments to keep {} on disk.'.format(self.removed, self.keep)
+        if self.failed:
+            comment += ' Failed to archive {} segments.'.format(self.failed)
+
+        return comment.strip()
+
+    def _run(self):
+        while True:
+            stopping = self._stopping.wait(self.poll)
+            segments = self.segments()
+            # All but the newest are finished, until tcpdump stops.
+            finished = segments if stopping else segments[:-1]
+            try:
+                self._handle(finished)
+            except OSError as e:
+                log.error('Error handling capture segments: {}'.format(e))
+
+            if stopping:
+                return
+
+    def _handle(self, finished):
+        self._finished &= set(finished)
+        for segment in finished:
+            if segment in self._finished:
+                continue
+
+            if self.archive_path and self._archive(segment):
+                continue
+
+            self._finished.add(segment)
+
+        if self.keep and len(self._finished) > self.keep:
+            for segment in sorted(self._finished, key=finished.index)[:-self.keep]:
+                log.info('removing capture segment {}'.format(segment))
+                unlink(segment)
+                self._finished.discard(segment)
+                self.removed += 1
+
+    def _archive(self, segment):
+        dest = path_join(self.archive_path, '{}{}.gz'.format(self.prefix, basename(segment)))
+        try:
+            # Written under another name first, so that nothing is seen in the archive half written.
+            with open(segment, 'rb') as src, gzip.open(dest + '.part', 'wb', compresslevel=1) as dst:
+                copyfileobj(src, dst, _CHUNK_SIZE)
+
+            rename(dest + '.part', dest)
+            unlink(segment)
+        except OSError as e:
+            log.error('Unable to archive {} to {}: {}'.format(segment, dest, e))
+            self.failed += 1
+            return False
+
+        log.info('archived {} --> {}'.format(segment, dest))
+        self.archived += 1
+        return True
+
 # Add instance of this agent to the server.
 def AddServicer(server):
     pb_grpc.add_TcpdumpAgentServicer_to_server(TcpdumpAgentServicer(), server)
@@ -25,6 +154,10 @@ class TcpdumpAgentServicer(pb_grpc.TcpdumpAgentServicer):
 
         self._proc = None
         self._lfile = None
+        # The segments of a rotating capture, if one is running.
+        self._ring = None
+        # Interfaces of destinations and addresses, kept between captures.
+        self._routes = netroute.Resolver()
 
     def Configure(self, request, context):
         self.dumpfile = request.dumpfile
@@ -37,7 +170,12 @@ class TcpdumpAgentServicer(pb_grpc.TcpdumpAgentServicer):
             request.expression,
             request.destination,
             request.dump_args,
-            request.capture_address
+            request.capture_address,
+            request.segment_mb,
+            request.segment_seconds,
+            request.segments,
+            request.archive_path,
+            request.tag
         )
 
     def StopCollection(self, request, context):
@@ -48,10 +186,127 @@ class TcpdumpAgentServicer(pb_grpc.TcpdumpAgentServicer):
     def ArchiveDump(self, request, context):
         return self._archive_dump(request.path, request.filename, request.tag)
 
+    def FetchDump(self, request, context):
+        filename = request.filename if request.filename else self.dumpfile
+        chunk_size = min(request.chunk_size, _MAX_CHUNK_SIZE) if request.chunk_size > 0 else _CHUNK_SIZE
+        try:
+            fd = open(filename, 'rb')
+        except OSError as e:
+            context.abort(grpc.StatusCode.NOT_FOUND, 'Unable to open {}: {}'.format(filename, e))
+
+        with fd:
+            size = fstat(fd.fileno()).st_size
+            if request.offset > size:
+                context.abort(grpc.StatusCode.OUT_OF_RANGE, 'Offset {} is past the end of {} ({} bytes).'.format(
+                    request.offset, filename, size))
+
+            log.info('sending {} from {} of {} bytes'.format(filename, request.offset, size))
+            fd.seek(request.offset)
+            offset = request.offset
+            # An empty file still gets a chunk, so the caller learns the size.
+            while offset < size or offset == request.offset:
+                data = fd.read(min(chunk_size, size - offset))
+                if not data and offset < size:
+                    # The file was truncated under us.
+                    context.abort(grpc.StatusCode.DATA_LOSS, '{} shrank while being sent.'.format(filename))
+
+                chunk = pb.DumpChunk(offset=offset, length=len(data), size=size)
+                compressed = zlib.compress(data, 1) if request.compress else None
+                if compressed is not None and len(compressed) < len(data):
+                    chunk.data = compressed
+                    chunk.compressed = True
+                else:
+                    chunk.data = data
+
+                offset += len(data)
+                yield chunk
+                if not data:
+                    break
+
+    def Summarize(self, request, context):
+        filename = request.filename if request.filename else self.dumpfile
+        start = time()
+        try:
+            summary = pcap.summarize(filename, request.interval, request.top)
+        except (OSError, ValueError, pcap.PcapError) as e:
+            msg = 'Unable to summarize {}: {}'.format(filename, e)
+            log.error(msg)
+            return pb.FlowSummary(success=False, comment=msg)
+
+        comment = 'Summarized {} packets into {} flows in {:.2f}s'.format(
+            summary.packets, summary.flow_count, time() - start)
+        log.info('{}: {}'.format(filename, comment))
+        response = pb.FlowSummary(success=True, comment=comment, flow_count=summary.flow_count, packets=summary.packets, bytes=summary.bytes,
+                                  other_packets=summary.other_packets, start=summary.start, end=summary.end,
+                                  interval=summary.interval, truncated=summary.truncated)
+        for f in summary.flows:
+            response.flows.add(protocol=f.protocol, src=f.src, sport=f.sport, dst=f.dst, dport=f.dport,
+                               packets=f.packets, bytes=f.bytes, first=f.first, last=f.last,
+                               interval_packets=f.interval_packets, interval_bytes=f.interval_bytes)
+
+        return response
+
     def Status(self, request, context):
-        return pb.Response(success=True, comment="")
+        interval = max(request.interval, _MIN_STATUS_INTERVAL) if request.interval > 0 else _STATUS_INTERVAL
+        follower = pcap.PcapFollower(self.dumpfile)
+        # Counts of the segments of a rotating capture before the one being followed.
+        done_packets, done_bytes = 0, 0
+        cancelled = Event()
+        context.add_callback(cancelled.set)
+        sent = 0
+        last = None
+        while True:
+            status = pb.TcpDumpStatus(active=self._proc is not None and self._proc.poll() is None)
+            packets, nbytes = 0, 0
+            ring = self._ring
+            # The dumpfile may be configured, or rotated, while the stream is open.
+            filename = ring.live() if ring else self.dumpfile
+            if follower.filename != filename:
+                if ring:
+                    # Count the end of the segment tcpdump just finished, unless it is already archived.
+                    before = follower.packets, follower.bytes
+                    try:
+                        follower.read()
+                    except (OSError, pcap.PcapError):
+                        pass
+
+                    if follower.packets >= before[0]:
+                        packets, nbytes = follower.packets - before[0], follower.bytes - before[1]
+                        before = follower.packets, follower.bytes
+
+                    done_packets += before[0]
+                    done_bytes += before[1]
+                else:
+                    done_packets, done_bytes = 0, 0
+
+                follower = pcap.PcapFollower(filename)
 
-    def _start_collection(self, expression=None, destination=None, dump_args=None, capture_address=None):
+            try:
+                new_packets, new_bytes = follower.read()
+                packets += new_packets
+                nbytes += new_bytes
+            except (OSError, pcap.PcapError) as e:
+                status.comment = 'Unable to read {}: {}'.format(follower.filename, e)
+
+            now = time()
+            if last is not None:
+                status.interval = now - last
+                status.packet_rate = packets / status.interval
+                status.byte_rate = nbytes / status.interval
+
+            last = now
+            status.captured = done_packets + follower.packets
+            status.bytes = done_bytes + follower.bytes
+            status.file_size = follower.size
+            status.last_packet = follower.last
+            yield status
+
+            sent += 1
+            if sent == request.count or cancelled.wait(interval):
+                break
+
+    def _start_collection(self, expression=None, destination=None, dump_args=None, capture_address=None,
+                          segment_mb=0, segment_seconds=0, segments=0, archive_path=None, tag=None):
         if self._proc:
             log.info('tcpdump already running. Stopping it so we can restart it...')
             self._stop_collection(force=True)
@@ -80,7 +335,28 @@ class TcpdumpAgentServicer(pb_grpc.TcpdumpAgentServicer):
         else:
             cmd += ' -i any'
 
-        cmd += ' -w {}'.format(self.dumpfile)
+        if segment_mb > 0 or segment_seconds > 0:
+            if archive_path:
+                try:
+                    makedirs(archive_path, exist_ok=True)
+                except OSError as e:
+                    msg = 'Unable to create archive path {}: {}'.format(archive_path, e)
+                    log.critical(msg)
+                    return pb.Response(success=False, comment=msg)
+
+            if tag:
+                prefix = '{}.{}-{}-'.format(strftime('%Y%m%d-%H%M'), tag, self._node_name())
+            else:
+                prefix = '{}.{}-'.format(strftime('%Y%m%d-%H%M'), self._node_name())
+
+            self._ring = _SegmentRing(self.dumpfile, segment_seconds > 0, segments, archive_path, prefix)
+            cmd += ' -w {}'.format(self._ring.template)
+            if segment_mb > 0:
+                cmd += ' -C {}'.format(segment_mb)
+            if segment_seconds > 0:
+                cmd += ' -G {}'.format(segment_seconds)
+        else:
+            cmd += ' -w {}'.format(self.dumpfile)
     
         if dump_args:
             cmd += ' {}'.format(dump_args)
@@ -97,6 +373,7 @@ class TcpdumpAgentServicer(pb_grpc.TcpdumpAgentServicer):
         except OSError as e:
             self._lfile.close()
             self._proc = None
+            self._stop_ring()
             msg = 'Unable to run cmd {}: {}'.format(cmd, e)
             log.critical(msg)
             return pb.Response(success=False, comment=msg)
@@ -106,6 +383,7 @@ class TcpdumpAgentServicer(pb_grpc.TcpdumpAgentServicer):
             msg = 'Could not start tcpdump'
             log.info(msg)
             self._proc = None
+            self._stop_ring()
             return pb.Response(success=False, comment=msg)
 
         msg = 'tcpdump started with process id {}'.format(self._proc.pid)
@@ -131,7 +409,16 @@ class TcpdumpAgentServicer(pb_grpc.TcpdumpAgentServicer):
             self._lfile.close()
             self._proc = None
 
-        return pb.Response(success=True, comment="")
+        return pb.Response(success=True, comment=self._stop_ring())
+
+    def _stop_ring(self):
+        if not self._ring:
+            return ''
+
+        log.info('finishing the capture segments')
+        comment = self._ring.stop()
+        self._ring = None
+        return comment
 
     def _archive_dump(self, archivepath, dumpfile, tag):
         create = True
@@ -160,36 +447,10 @@ class TcpdumpAgentServicer(pb_grpc.TcpdumpAgentServicer):
         return pb.Response(success=True, comment=comment)
 
     def _addr2iface(self, inaddr):
-        for iface in interfaces():
-            addrs = ifaddresses(iface)
-            if AF_INET in addrs:
-                for addr in addrs[AF_INET]:
-                    if inaddr == addr['addr']:
-                        return iface
-
-        return None
+        return self._routes.addr2iface(inaddr)
 
     def _dest2iface(self, destination):
-        addr = gethostbyname(destination)
-        if not addr:
-            log.critical('Unable to get address for {}'.format(destination))
-            return None
-
-        cmd = 'ip route get {}'.format(addr)
-        try:
-            out = check_output(cmd.split()).decode("utf-8")   # out ==> bytes to str
-        except CalledProcessError as e:
-            log.critical('Error invoking "{}": {}'.format(cmd, e))
-            return None
-
-        line = out.split('\n')[0].split()
-        iface = line[line.index('dev')+1]  # dev name is always just after "dev" 
-
-        if not iface:
-            log.critical('Unable to find device name in ip route output: {}'.format(line))
-            return None
-        
-        return iface
+        return self._routes.dest2iface(destination)
 
     def _node_name(self):
         return gethostname().split('.')[0]